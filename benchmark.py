@@ -0,0 +1,554 @@
+"""
+Author: Tomas Dal Farra
+Date: 16/10/2026
+Description: Loopback benchmarks for Remote-Controlling
+"""
+import asyncio
+import multiprocessing
+import os
+import socket
+import ssl
+import threading
+import time
+import numpy as np
+from server import Server, new_event_loop, raise_file_limit, start_workers
+import random
+from datacomp import StreamEncode, StreamDecode, VideoReceiver, CodecProfile
+from rtp import JitterBuffer
+
+
+def client_context() -> ssl.SSLContext:
+    """
+    Creates a client tls context that accepts the self-signed certificate
+    :return: client ssl context
+    """
+    context = ssl.create_default_context()
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+def serve(port: int, conn):
+    """
+    Runs a server and sends through conn its cpu time of every second until conn receives something
+    :param port: port for the server to bind to
+    :param conn: multiprocessing connection with the benchmark process
+    """
+    Server.port = port
+    raise_file_limit()
+    server = Server()
+
+    async def run():
+        task = asyncio.ensure_future(server.run_server())
+        times = []
+        while not conn.poll():
+            await asyncio.sleep(1)
+            times.append(time.process_time())
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        return times
+
+    loop = new_event_loop()
+    try:
+        conn.send(loop.run_until_complete(run()))
+    finally:
+        loop.close()
+
+
+async def present_hosts(count: int, port: int, concurrency=100) -> list:
+    """
+    Connects hosts to the server and presents them
+    :param count: amount of hosts
+    :param port: server port
+    :param concurrency: how many hosts connect at the same time
+    :return: list of the hosts stream writers
+    """
+    context = client_context()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def present(number):
+        async with semaphore:
+            _, writer = await asyncio.open_connection('127.0.0.1', port, ssl=context)
+            writer.write(Server.protocol('present', f'{number:0{Server.id_length}d}').encode())
+            await writer.drain()
+            return writer
+
+    return await asyncio.gather(*(present(number) for number in range(count)))
+
+
+def bench_hosts(count=5000, idle=5, port=5110) -> str:
+    """
+    Registers many idle hosts in a server and measures the server cpu usage while they are idle
+    :param count: amount of hosts
+    :param idle: seconds to measure after all hosts are registered
+    :param port: server port
+    :return: results of the benchmark
+    """
+    raise_file_limit()
+    conn, child = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=serve, args=(port, child))
+    process.start()
+    time.sleep(1)       # server startup
+    loop = new_event_loop()
+    try:
+        start = time.time()
+        hosts = loop.run_until_complete(present_hosts(count, port))
+        registered = time.time() - start
+        loop.run_until_complete(asyncio.sleep(idle + 1))
+        conn.send('stop')
+        times = conn.recv()
+        for writer in hosts:
+            writer.close()
+    finally:
+        loop.close()
+        process.join()
+    idle_cpu = (times[-1] - times[-1 - idle]) / idle
+    return f"{count} hosts registered in {registered:.2f}s, idle server cpu: {idle_cpu * 1000:.2f}ms/s"
+
+
+def handshake_loop(port: int, seconds: float) -> int:
+    """
+    Does tls handshakes with the server one after the other
+    :param port: server port
+    :param seconds: how long to keep doing handshakes
+    :return: amount of handshakes done
+    """
+    context = client_context()
+    count = 0
+    end = time.time() + seconds
+    while time.time() < end:
+        with socket.create_connection(('127.0.0.1', port)) as tcp:
+            with context.wrap_socket(tcp, server_hostname='127.0.0.1'):
+                count += 1
+    return count
+
+
+def bench_handshakes(workers=(1, 2, 4), clients=8, seconds=5, port=5111) -> str:
+    """
+    Measures how many tls handshakes per second the server does with different amounts of worker processes
+    :param workers: amounts of worker processes to test
+    :param clients: client processes doing handshakes at the same time
+    :param seconds: how long each test lasts
+    :param port: server port
+    :return: results of the benchmark
+    """
+    Server.port = port
+    results = []
+    with multiprocessing.Pool(clients) as pool:
+        for count in workers:
+            processes = start_workers(count)
+            time.sleep(1)       # workers startup
+            try:
+                total = sum(pool.starmap(handshake_loop, [(port, seconds)] * clients))
+            finally:
+                for process in processes:
+                    process.terminate()
+                    process.join()
+            results.append(f"{count} workers: {total / seconds:.0f} handshakes/s")
+    return "\n".join(results)
+
+
+def bench_resumption(count=200, port=5112) -> str:
+    """
+    Compares full tls handshakes with resumed ones (the client offers the session ticket of its last connection)
+    :param count: handshakes of each kind
+    :param port: server port
+    :return: results of the benchmark
+    """
+    Server.port = port
+    processes = start_workers(1)
+    time.sleep(1)       # server startup
+    ping = Server.protocol('ping').encode()
+    results = []
+    try:
+        for resume in (False, True):
+            context = client_context()
+            session = None
+            total = 0
+            for _ in range(count):
+                with socket.create_connection(('127.0.0.1', port)) as tcp:
+                    start = time.perf_counter()
+                    with context.wrap_socket(tcp, server_hostname='127.0.0.1', session=session) as tls:
+                        total += time.perf_counter() - start
+                        # the ticket arrives after the handshake, the answer to a ping brings it
+                        tls.sendall(ping)
+                        tls.recv(Server.max_buffer)
+                        if resume:
+                            session = tls.session
+            kind = "resumed" if resume else "full"
+            results.append(f"{kind} handshake: {total / count * 1000:.2f}ms")
+    finally:
+        for process in processes:
+            process.terminate()
+            process.join()
+    return "\n".join(results)
+
+
+def desktop_clip(kind: str, width=1280, height=720, frames=60) -> list:
+    """
+    Creates a synthetic screen recording (the same for every run)
+    :param kind: static (nothing moves), typing (a line of text grows), scrolling (the page moves)
+    or video (a noisy area plays)
+    :param width: frames width
+    :param height: frames height
+    :param frames: amount of frames
+    :return: list of rgb24 frames
+    """
+    rng = np.random.default_rng(0)
+    desktop = np.full((height, width, 3), 235, np.uint8)
+    desktop[:40] = 60                                       # top bar
+    desktop[80:height - 60, 100:width - 100] = 255          # window
+    for y in range(100, height - 80, 24):                   # lines of "text"
+        desktop[y:y + 10, 120:width - 120, :][:, rng.random(width - 240) < 0.35] = 30
+    clip = []
+    for index in range(frames):
+        frame = desktop.copy()
+        if kind == 'typing':
+            frame[height // 2:height // 2 + 10, 120:120 + index * 8 % (width - 240)] = 30
+        elif kind == 'scrolling':
+            frame[80:height - 60] = np.roll(desktop[80:height - 60], -index * 8, axis=0)
+        elif kind == 'video':
+            frame[100:100 + height // 2, 140:140 + width // 2] = rng.integers(0, 256, (height // 2, width // 2, 3),
+                                                                              np.uint8)
+        clip.append(frame)
+    return clip
+
+
+def encode_clip(profile: str, clip: list) -> tuple:
+    """
+    Encodes a clip as fast as the encoder can
+    :param profile: name of the codec profile
+    :param clip: list of rgb24 frames
+    :return: (frames per second, cpu seconds per frame, bytes per frame)
+    """
+    height, width = clip[0].shape[:2]
+    encoder = StreamEncode(width, height, StreamEncode.standard_url, 'rgb24', profile=profile)
+    before = os.times()
+    start = time.perf_counter()
+    encoder.run_encoder()
+
+    def feed():
+        for frame in clip:
+            encoder.write_stdin(frame)
+        encoder.process.stdin.close()
+
+    writer = threading.Thread(target=feed)
+    writer.start()
+    size = 0
+    while chunk := encoder.process.stdout.read(65536):
+        size += len(chunk)
+    writer.join()
+    encoder.process.wait()
+    elapsed = time.perf_counter() - start
+    after = os.times()
+    encoder.process.stdout.close()
+    # the cpu of the ffmpeg process (children times are only known after it ends)
+    cpu = after.children_user - before.children_user + after.children_system - before.children_system
+    return len(clip) / elapsed, cpu / len(clip), size / len(clip)
+
+
+def bench_codecs(profiles=None, kinds=('static', 'typing', 'scrolling', 'video'), width=1280, height=720,
+                 frames=60) -> str:
+    """
+    Measures the cost and size of every codec profile on synthetic screen recordings
+    :param profiles: names of the profiles to test (every profile the installed ffmpeg can encode if None)
+    :param kinds: kinds of clips
+    :param width: frames width
+    :param height: frames height
+    :param frames: frames of each clip
+    :return: results of the benchmark
+    """
+    if profiles is None:
+        profiles = [name for name, profile in CodecProfile.profiles.items() if profile.can_encode()]
+    clips = {kind: desktop_clip(kind, width, height, frames) for kind in kinds}
+    results = []
+    for profile in profiles:
+        for kind, clip in clips.items():
+            fps, cpu, size = encode_clip(profile, clip)
+            results.append(f"{profile} {kind}: {fps:.1f} fps, {cpu * 1000:.2f}ms cpu/frame, {size:.0f} bytes/frame")
+    return "\n".join(results)
+
+
+class LossyProxy:
+    """
+    Forwards udp datagrams on loopback and loses some of them (like a bad network).
+    What the destination answers goes back to the sender without loss
+    """
+    max_datagram = 65536
+    poll = 0.5                  # seconds the proxy waits before checking if it was closed
+
+    def __init__(self, port: int, destination: int, loss=0.0):
+        """
+        Binds the proxy
+        :param port: port the proxy receives on
+        :param destination: port the proxy forwards to
+        :param loss: fraction of datagrams lost at random
+        """
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', port))
+        self.sock.settimeout(LossyProxy.poll)          # closing the socket does not wake a blocked recv
+        self.destination = ('127.0.0.1', destination)
+        self.loss = loss
+        self.burst = 0              # next datagrams to lose
+        self.source = None          # address of the sender (answers go to it)
+        self.forwarded = 0
+        self.lost = 0
+        self.random = random.Random(0)
+        self.thread = threading.Thread(target=self.forward)
+
+    def start(self):
+        """ Starts forwarding """
+        self.thread.start()
+
+    def drop(self, count: int):
+        """
+        Loses the next datagrams
+        :param count: how many
+        """
+        self.burst = count
+
+    def forward(self):
+        """ Forwards datagrams until the proxy is closed (proxy thread) """
+        buffer = bytearray(LossyProxy.max_datagram)
+        view = memoryview(buffer)
+        while True:
+            try:
+                size, address = self.sock.recvfrom_into(buffer)
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+            if address == self.destination:
+                if self.source is not None:
+                    self.sock.sendto(view[:size], self.source)
+                continue
+            self.source = address
+            if self.burst > 0 or self.random.random() < self.loss:
+                self.burst = max(self.burst - 1, 0)
+                self.lost += 1
+                continue
+            self.sock.sendto(view[:size], self.destination)
+            self.forwarded += 1
+
+    def close(self):
+        """ Stops forwarding """
+        self.sock.close()
+        self.thread.join()
+
+
+def bench_recovery(profile=CodecProfile.default, bursts=5, burst=10, width=1280, height=720, fps=30,
+                   port=5113) -> str:
+    """
+    Loses bursts of video datagrams and measures how long the decoder takes to recover asking for keyframes
+    :param profile: name of the codec profile
+    :param bursts: amount of losses (one every two seconds)
+    :param burst: datagrams lost every time
+    :param width: video width
+    :param height: video height
+    :param fps: frames per second sent
+    :param port: port of the proxy (the decoder receives on the next one)
+    :return: results of the benchmark
+    """
+    clip = desktop_clip('scrolling', width, height, fps)
+    proxy = LossyProxy(port, port + 1)
+    proxy.start()
+    decoder = StreamDecode(width, height, StreamDecode.standard_url, profile)
+    decoder.run_decoder()
+    receiver = VideoReceiver(port + 1, decoder, rtp=CodecProfile.get(profile).rtp)
+    receiver.start()
+    encoder = StreamEncode(width, height, f'udp://127.0.0.1:{port}', 'rgb24', profile=profile, rtp=True)
+    encoder.run_encoder()
+
+    def read():
+        # the guest side: it asks for a keyframe when frames have errors
+        try:
+            while len(decoder.read_stdout()):
+                if decoder.needs_keyframe():
+                    decoder.keyframe_requested()
+                    encoder.request_keyframe()
+        except (OSError, ValueError):           # decoder closed
+            pass
+
+    reader = threading.Thread(target=read)
+    reader.start()
+    try:
+        for index in range(fps * 2 * (bursts + 1)):
+            start = time.perf_counter()
+            encoder.write_stdin(clip[index % len(clip)])
+            if index % (fps * 2) == fps and index > fps * 2:      # after the first two seconds (the join)
+                proxy.drop(burst)
+            time.sleep(max(0.0, 1 / fps - (time.perf_counter() - start)))
+    finally:
+        encoder.close()
+        receiver.close()
+        decoder.close()
+        proxy.close()
+        reader.join()
+    return f"{profile}: lost {proxy.lost} of {proxy.lost + proxy.forwarded} datagrams, {decoder.recovery()}"
+
+
+def drain(decoder: StreamDecode):
+    """
+    Reads decoded frames until the decoder is closed (the decoder blocks if its frames are not read)
+    :param decoder: running decoder
+    """
+    try:
+        while len(decoder.read_stdout()):
+            pass
+    except (OSError, ValueError):           # decoder closed
+        pass
+
+
+def bench_protection(profile=CodecProfile.default, loss=0.02, seconds=5, width=1280, height=720, fps=30,
+                     port=5115) -> list:
+    """
+    Sends video through a proxy that loses datagrams at random with every loss recovery setting
+    :param profile: name of a codec profile sent in rtp
+    :param loss: fraction of datagrams lost
+    :param seconds: seconds of video for every setting
+    :param width: video width
+    :param height: video height
+    :param fps: frames per second sent
+    :param port: port of the proxy (the decoder receives on the next one)
+    :return: results of every setting
+    """
+    clip = desktop_clip('scrolling', width, height, fps)
+    results = []
+    for name, nack, fec in (('none', False, False), ('nack', True, False), ('fec', False, True),
+                            ('nack+fec', True, True)):
+        proxy = LossyProxy(port, port + 1, loss)
+        proxy.start()
+        decoder = StreamDecode(width, height, StreamDecode.standard_url, profile)
+        decoder.run_decoder()
+        receiver = VideoReceiver(port + 1, decoder, rtp=True, nack=nack)
+        receiver.start()
+        encoder = StreamEncode(width, height, f'udp://127.0.0.1:{port}', 'rgb24', profile=profile, rtp=True)
+        encoder.run_encoder()
+        if fec:
+            encoder.protect(int(loss * 1000))
+        reader = threading.Thread(target=drain, args=(decoder,))
+        reader.start()
+        try:
+            for index in range(fps * seconds):
+                start = time.perf_counter()
+                encoder.write_stdin(clip[index % len(clip)])
+                time.sleep(max(0.0, 1 / fps - (time.perf_counter() - start)))
+            time.sleep(JitterBuffer.max_delay)          # the last losses are recovered or given up
+        finally:
+            sender = encoder.sender
+            encoder.close()
+            receiver.close()
+            decoder.close()
+            proxy.close()
+            reader.join()
+        overhead = (sender.retransmitted + sender.parities) / max(sender.sent, 1) * 100
+        results.append(f"{profile} {name}: {receiver.recovery()}, overhead {overhead:.1f}%")
+    return results
+
+
+def stamp(frame: np.ndarray, index: int):
+    """
+    Draws the number of a frame as a row of black and white blocks (it survives encoding)
+    :param frame: rgb24 frame
+    :param index: number of the frame (16 bits)
+    """
+    for bit in range(16):
+        frame[:32, bit * 32:(bit + 1) * 32] = 255 if index >> bit & 1 else 0
+
+
+def read_stamp(frame, width: int, height: int) -> int:
+    """
+    Reads the number drawn by stamp in a decoded frame
+    :param frame: decoded rgb24 frame (numpy array)
+    :param width: frame width
+    :param height: frame height
+    :return: number of the frame
+    """
+    image = np.asarray(frame).reshape(height, width, 3)
+    return sum(1 << bit for bit in range(16) if image[16, bit * 32 + 16, 0] > 127)
+
+
+def bench_latency(profile=CodecProfile.default, seconds=5, width=1280, height=720, fps=30, port=5117) -> list:
+    """
+    Measures the latency from a frame being sent to the encoder until its decoded frame is read,
+    with the default decoder input and with the low latency one
+    :param profile: name of a codec profile sent in rtp
+    :param seconds: seconds of video for every setting
+    :param width: video width
+    :param height: video height
+    :param fps: frames per second sent
+    :param port: port the decoder receives on
+    :return: results of every setting
+    """
+    clip = desktop_clip('typing', width, height, fps)
+    results = []
+    previous = StreamDecode.low_latency     # the setting is global, it is put back afterwards
+    try:
+        for low_latency in (False, True):
+            StreamDecode.low_latency = low_latency
+            decoder = StreamDecode(width, height, StreamDecode.standard_url, profile)
+            decoder.run_decoder()
+            receiver = VideoReceiver(port, decoder, rtp=True)
+            receiver.start()
+            encoder = StreamEncode(width, height, f'udp://127.0.0.1:{port}', 'rgb24', profile=profile, rtp=True)
+            encoder.run_encoder()
+            sent = {}                   # format: {frame number: time it was sent}
+            latencies = []
+
+            def read():
+                try:
+                    while True:
+                        frame = decoder.read_stdout()
+                        if not len(frame):
+                            return
+                        start = sent.pop(read_stamp(frame, width, height), None)
+                        if start is not None:
+                            latencies.append(time.perf_counter() - start)
+                except (OSError, ValueError):           # decoder closed
+                    pass
+
+            reader = threading.Thread(target=read)
+            reader.start()
+            try:
+                for index in range(fps * seconds):
+                    start = time.perf_counter()
+                    frame = clip[index % len(clip)].copy()
+                    stamp(frame, index)
+                    sent[index] = start
+                    encoder.write_stdin(frame)
+                    time.sleep(max(0.0, 1 / fps - (time.perf_counter() - start)))
+                time.sleep(0.5)                         # the last frames are decoded
+            finally:
+                encoder.close()
+                receiver.close()
+                decoder.close()
+                reader.join()
+            latencies.sort()
+            if not latencies:
+                results.append(f"{profile} low latency {low_latency}: no frames decoded")
+                continue
+            average = sum(latencies) / len(latencies) * 1000
+            worst = latencies[int(len(latencies) * 0.95)] * 1000
+            results.append(f"{profile} low latency {low_latency}: {len(latencies)} frames, "
+                           f"average {average:.1f}ms, 95th percentile {worst:.1f}ms")
+    finally:
+        StreamDecode.low_latency = previous
+    return results
+
+
+def main():
+    for count in (500, 5000):
+        print(bench_hosts(count))
+    print(bench_handshakes())
+    print(bench_resumption())
+    print(bench_codecs())
+    print(bench_recovery())
+    print("\n".join(bench_protection()))
+    print("\n".join(bench_latency()))
+
+
+if __name__ == "__main__":
+    main()
@@ -7,10 +7,16 @@ import logging
 import socket
 import ssl
 import select
+import selectors
 from dataexct import UseKeyBoard, UseMouse
+from datacomp import CodecProfile
+from framing import MessageDecoder, SendQueue
 from OpenSSL import crypto
+from cryptography.hazmat.primitives.asymmetric import ec
 import os
 import ctypes
+import time
+import threading
 
 
 def cert_gen():
@@ -31,9 +37,8 @@ def cert_gen():
     cert_file = 'certificate.crt'
     key_file = 'privatekey.key'
 
-    # generate key
-    key = crypto.PKey()
-    key.generate_key(crypto.TYPE_RSA, 4096)
+    # generate key (ecdsa p-256 is generated instantly and makes handshakes much cheaper than rsa 4096)
+    key = crypto.PKey.from_cryptography_key(ec.generate_private_key(ec.SECP256R1()))
     # create self-signed certificate
     cert = crypto.X509()
     cert.get_subject().C = country_name
@@ -62,7 +67,7 @@ class Client:
     server_port = 5010
     max_buffer = 256
     # available commands that arrive to client
-    commands = ["GUESTING", "REQUEST", "ABORT", "RETRY", "CONNECT", "RESOLUTION"]
+    commands = ["GUESTING", "REQUEST", "ABORT", "RETRY", "CONNECT", "RESOLUTION", "PONG", "RELAY", "CODECS"]
 
     def __init__(self, ip, user_id, sock, lock):
         """
@@ -76,6 +81,7 @@ class Client:
         self.server_ip = ip
         self.server_address = (self.server_ip, Client.server_port)
         self.secure_client = sock
+        self.decoder = MessageDecoder(self.valid, Client.max_buffer)     # decodes server messages
         self.lock = lock
 
     def present(self):
@@ -85,6 +91,16 @@ class Client:
         self.secure_client.send(f'PRESENT {self.id};;'.encode())
         # except socket.error
 
+    def receive(self) -> list:
+        """
+        Waits for the next message from the server (server communication must be blocking)
+        :return: validated message (keepalive answers are skipped), None if the server disconnected
+        """
+        data = self.decoder.receive(self.secure_client)
+        while data and data[0] == "PONG":
+            data = self.decoder.receive(self.secure_client)
+        return data
+
     def connected(self):
         """ Sends connected to server to end their connection (it is now connected point to point) """
         self.secure_client.send(self.protocol('connected').encode())
@@ -116,7 +132,9 @@ class Client:
         :return: if data is valid returns list with command and arguments, if not returns empty list
         """
         split = data.split()
-        if (split[0] not in Client.commands) or (data[-2:] != ';;'):
+        if data == "PONG;;":
+            return ["PONG"]
+        elif (split[0] not in Client.commands) or (data[-2:] != ';;'):
             return []
         elif split[0] == "GUESTING" and len(split) == 3:
             # the first argument is a text writing what is the second item telling
@@ -135,12 +153,20 @@ class Client:
             return [split[0], split[1][:-2]]
         elif split[0] == "RESOLUTION" and len(split) == 3 and split[1].isnumeric() and split[2][:-2].isnumeric():
             return [split[0], int(split[1]), int(split[2][:-2])]
+        elif split[0] == "RELAY" and len(split) == 4 and split[1].isnumeric() and split[2].isnumeric():
+            # RELAY tcp_port udp_port token
+            return [split[0], int(split[1]), int(split[2]), split[3][:-2]]
+        elif split[0] == "CODECS" and len(split) >= 2:
+            # CODECS profile1 profile2 ... (in order of preference)
+            return split[:-1] + [split[-1][:-2]]
         else:
             return []
 
 
 class ClientGuest(Client):
     """ Client communications for guest mode """
+    connect_timeout = 5         # seconds to try to connect directly to the host before using the relay
+    id_retry = 3                # seconds of the RETRY the server answers when the host id is not available
 
     def __init__(self, server_ip, user_id, sock, lock):
         """
@@ -151,34 +177,58 @@ class ClientGuest(Client):
         :param lock: threading lock to organize host and guest actions
         """
         super().__init__(server_ip, user_id, sock, lock)
-
         self.context = ssl.create_default_context()
         # allow self-signed certificates
         self.context.check_hostname = False
         self.context.verify_mode = ssl.CERT_NONE
+        self.codec = CodecProfile.default   # codec profile of the video (chosen after the resolution)
+        self.pyav = False                   # the video is decoded with PyAV (profiles are chosen for it)
 
         self.guest = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.secure_guest = None         # SSL wrapped socket when we already know the
+        self.guest_decoder = MessageDecoder(self.valid, Client.max_buffer)   # decodes host messages
         self.guest_mode = False          # server communication blocks?
 
-    def connect_id(self, host_id: str) -> int:
-        """
-        Sends a host id to the server
-        :param host_id: host's id
-        :return: if the id was correct -1, if not how much time to wait to continue communication
-        """
-        # Adapts server connection for guest mode
+    def start_guest_mode(self):
+        """ Adapts server connection for guest mode """
         if not self.guest_mode:
             self.lock.acquire(True)
             self.secure_client.setblocking(True)    # communication with the server blocks
             self.secure_client.settimeout(120)      # if server does not answer in two minutes something happened
             self.guest_mode = True
             self.lock.release()
-        # ---------------------------------------
+
+    def connect(self, host_id: str, password: str) -> tuple[str, int]:
+        """
+        Sends a host id and its password to the server in one message (a single round trip)
+        :param host_id: host's id
+        :param password: host's password
+        :return: host address to connect, if not succeeded,
+        it returns (RETRY, time to wait)
+        """
+        self.start_guest_mode()
+        self.secure_client.send(self.protocol('guesting', 'pair', host_id, password).encode())
+        data = self.receive()
+        print(data)
+        if data:
+            if data[0] == "CONNECT" and data[2].isnumeric():
+                return data[1], int(data[2])
+            elif data[0] == "RETRY" and data[1].isnumeric():
+                return data[0], int(data[1])
+            elif data[0] == "ABORT":
+                raise Exception(data[1])
+        raise ValueError("Not an appropriate answer from the server")
+
+    def connect_id(self, host_id: str) -> int:
+        """
+        Sends a host id to the server
+        :param host_id: host's id
+        :return: if the id was correct -1, if not how much time to wait to continue communication
+        """
+        self.start_guest_mode()
         self.secure_client.send(self.protocol('guesting', 'id', host_id).encode())
-        data = self.secure_client.recv(Client.max_buffer).decode()
+        data = self.receive()
         print(data)
-        data = self.valid(data)
         if data:
             if data[0] == "REQUEST" and data[1] == "password":
                 return -1
@@ -197,9 +247,8 @@ class ClientGuest(Client):
         it returns (RETRY, time to wait)
         """
         self.secure_client.send(self.protocol('guesting', 'password', password).encode())
-        data = self.secure_client.recv(Client.max_buffer).decode()
+        data = self.receive()
         print(data)
-        data = self.valid(data)
         if data:
             if data[0] == "CONNECT" and data[2].isnumeric():
                 return data[1], int(data[2])
@@ -221,7 +270,9 @@ class ClientGuest(Client):
         """
         try:
             self.secure_guest = self.context.wrap_socket(self.guest, server_hostname=ip)
+            self.secure_guest.settimeout(ClientGuest.connect_timeout)
             self.secure_guest.connect((ip, port))
+            self.secure_guest.settimeout(None)
             print("connected to host")
             self.connected()
             return True
@@ -229,28 +280,79 @@ class ClientGuest(Client):
             return False
         # finally
 
+    def connect_relay(self) -> bool:
+        """
+        Asks the server to relay the connection with the host (when connecting directly failed)
+        :return: if it succeeded establishing connection
+        """
+        self.secure_client.send(self.protocol('relay').encode())
+        data = self.receive()
+        print(data)
+        if not data or data[0] != "RELAY":
+            return False
+        tcp_port, udp_port, token = data[1:]
+        try:
+            relay = socket.create_connection((self.server_ip, tcp_port), ClientGuest.connect_timeout)
+            relay.sendall(token.encode())
+            self.secure_guest = self.context.wrap_socket(relay, server_hostname=self.server_ip)
+            self.secure_guest.settimeout(None)
+            # video arrives at the port under the input port, the relay learns its address from the token
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as video:
+                video.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                video.bind(('0.0.0.0', tcp_port - 1))
+                video.sendto(token.encode(), (self.server_ip, udp_port))
+            print("connected to host through the relay")
+            self.connected()
+            return True
+        except socket.error:
+            return False
+
     def recv_resolution(self) -> tuple:
-        """ Receives screen resolution from host """
-        resolution = self.secure_guest.recv(Client.max_buffer).decode()
+        """ Receives screen resolution from host and chooses the codec profile of the video """
+        resolution = self.guest_decoder.receive(self.secure_guest)
         print(resolution)
-        if resolution == "":
-            return -1, -1       # close connection
-        resolution = self.valid(resolution)
         if resolution and resolution[0] == "RESOLUTION":
-            width = resolution[1]
-            height = resolution[2]
+            self.choose_codec()
+            # the host scales its screen to our screen
+            width, height = self.viewport(resolution[1], resolution[2])
+            self.secure_guest.send(self.protocol("viewport", width, height).encode())
             return width, height
         else:
             return -1, -1       # close connection
 
+    @staticmethod
+    def viewport(width: int, height: int) -> tuple:
+        """
+        Size of the host screen scaled down to fit our screen (keeping its proportions)
+        :param width: host screen width
+        :param height: host screen height
+        :return: (width, height) of the video (even, for the video format)
+        """
+        user32 = ctypes.windll.user32
+        user32.SetProcessDPIAware()
+        scale = min(1, user32.GetSystemMetrics(0) / width, user32.GetSystemMetrics(1) / height)
+        return int(width * scale) & ~1, int(height * scale) & ~1
+
+    def choose_codec(self):
+        """ Chooses the first codec profile the host offers that we can decode """
+        offered = self.guest_decoder.receive(self.secure_guest)
+        if offered and offered[0] == "CODECS":
+            self.codec = CodecProfile.choose(offered[1:], self.pyav)
+        self.secure_guest.send(self.protocol("codec", self.codec).encode())
+        print(f"codec: {self.codec}")
+
 
 class ClientHost(Client):
     """ Client communications for host mode """
     listen_size = 1
+    wait_time = 0.2             # maximum seconds to wait for the server while holding the lock
+    ping_interval = 10          # seconds between keepalive messages to the server
     cert = 'certificate.crt'
     key = 'privatekey.key'
     # possible commands from a guest to execute
-    exct_commands = ('MOUSEPRESS', 'MOUSERELEASE', 'MOUSEMOVE', 'MOUSESCROLL', 'KEYPRESS', 'KEYRELEASE')
+    exct_commands = ('MOUSEPRESS', 'MOUSERELEASE', 'MOUSEMOVE', 'MOUSESCROLL', 'KEYPRESS', 'KEYRELEASE', 'STATS',
+                     'CODEC', 'VIEWPORT', 'KEYFRAME')
+    codec_timeout = 5           # seconds the guest has to choose a codec profile
 
     def __init__(self, server_ip, user_id, sock, lock):
         """
@@ -262,16 +364,28 @@ class ClientHost(Client):
         """
         super().__init__(server_ip, user_id, sock, lock)
         # ssl context
+        self.cert_thread = None
         if not (os.path.exists(ClientHost.cert) and os.path.exists(ClientHost.key)):
-            # if there is no certificate it creates one
-            cert_gen()
+            # if there is no certificate it creates one in the background (loaded when a guest is expected)
+            self.cert_thread = threading.Thread(target=cert_gen, name="CertThread")
+            self.cert_thread.start()
         self.context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
-        self.context.load_cert_chain(ClientHost.cert, ClientHost.key)
 
         self.connection_host = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.secure_connect = None         # SSL wrapped socket to establish a connection
         self.secure_host = None            # SSL wrapped socket when we already know the guest
-        self.messages = []                 # messages to send to the server
+        self.video_address = None          # where to send the video (guest or relay)
+        self.messages = SendQueue()        # messages to send to the server
+        self.selector = selectors.DefaultSelector()     # server socket is registered once
+        self.last_ping = time.monotonic()               # last time a keepalive was sent
+        self.host_decoder = MessageDecoder(self.valid_exct, Client.max_buffer)    # decodes guest instructions
+        self.on_input = None                # function called when a guest instruction is executed
+        self.on_stats = None                # function called with the video stats reported by the guest
+        self.on_keyframe = None             # function called when the guest asks for a keyframe
+        self.codec = CodecProfile.default   # codec profile chosen by the guest
+        self.pyav = False                   # the video is encoded with PyAV (profiles are offered for it)
+        self.viewport = None                # (width, height) of the video (the guest screen size)
+        self.scale = (1, 1)                 # host pixels for every video pixel (x, y)
 
         # hardware
         self.keyboard = UseKeyBoard()
@@ -282,63 +396,178 @@ class ClientHost(Client):
         Adds a message to send to server
         :param message: message for server (already over protocol)
         """
-        self.messages.append(message)
+        self.messages.put(message.encode())
 
     def communicate(self):
         """ Communicates with server """
         value = None            # does not return
         self.lock.acquire(True)
         if not self.secure_client.getblocking():
-            rlist, wlist, xlist = select.select([self.secure_client], [self.secure_client], [self.secure_client])
+            # keeps this host active in the server
+            if time.monotonic() - self.last_ping >= ClientHost.ping_interval:
+                self.message_server(self.protocol('ping'))
+                self.last_ping = time.monotonic()
+            # waits to write only when there are messages to send, and stops reading while too many wait
+            events = (0 if self.messages.is_full() else selectors.EVENT_READ) | \
+                     (selectors.EVENT_WRITE if self.messages else 0)
+            self.selector.modify(self.secure_client, events)
+            ready = 0
+            for _, mask in self.selector.select(ClientHost.wait_time):
+                ready |= mask
 
-            # exception
-            for s in xlist:
-                s.close()
-                raise socket.error("Error in the server connection")
             # read
-            for s in rlist:
+            if ready & selectors.EVENT_READ:
                 try:
-                    data = s.recv(Client.max_buffer).decode()
-                    print(data)
+                    commands = self.decoder.recv(self.secure_client)
+                    print(commands)
                 except ssl.SSLWantReadError:
                     # https://docs.python.org/3/library/ssl.html notes on non-blocking sockets
-                    continue
+                    commands = []
 
-                if data == "":
+                if commands is None:
                     # disconnect
+                    self.selector.unregister(self.secure_client)
                     self.secure_client.close()
                     self.messages.clear()
+                    commands = []
 
-                commands = data.split(';;')
                 for command in commands:
-                    command = self.valid(command+';;')
                     if command:
                         if command[0] == "GUESTING" and command[1] == "password":
                             value = command[2]          # will return the password received
                         elif command[0] == "ABORT":
                             raise Exception(command[1])
             # write
-            for message in self.messages:
-                if self.secure_client in wlist:
-                    self.secure_client.send(message.encode())
-                    self.messages.remove(message)
+            if ready & selectors.EVENT_WRITE and self.messages:
+                self.flush_server()
         else:
             value = '-1'
         self.lock.release()
         return value
 
+    def flush_server(self):
+        """ Sends the messages waiting for the server, once all are sent it only waits to read (lock held) """
+        self.messages.flush(self.secure_client)
+        if not self.messages:
+            self.selector.modify(self.secure_client, selectors.EVENT_READ)
+
+    def load_certificate(self):
+        """ Loads the certificate (waits for it if it is being created) and secures the listening socket """
+        if self.cert_thread is not None:
+            self.cert_thread.join()
+        self.context.load_cert_chain(ClientHost.cert, ClientHost.key)
+        self.secure_connect = self.context.wrap_socket(self.connection_host, server_side=True)
+
     def connect_host(self):
-        """ Connects host server to have a connection with a guest """
-        self.secure_host, _ = self.secure_connect.accept()
+        """ Connects host server to have a connection with a guest (directly or through the server relay) """
+        if self.secure_connect is None:
+            self.load_certificate()
+        self.selector.register(self.secure_connect, selectors.EVENT_READ)
+        try:
+            while self.secure_host is None:
+                for key, mask in self.selector.select():
+                    if key.fileobj is self.secure_connect:
+                        self.secure_host, _ = self.secure_connect.accept()
+                        self.video_address = (self.get_guest(), Client.client_port - 1)
+                    elif self.secure_host is None:
+                        if mask & selectors.EVENT_WRITE:
+                            with self.lock:
+                                if self.secure_client.getblocking():    # guest mode talks to the server now
+                                    self.selector.modify(self.secure_client, selectors.EVENT_READ)
+                                else:
+                                    self.flush_server()
+                        if mask & selectors.EVENT_READ:
+                            self.relay_answer()
+        finally:
+            self.selector.unregister(self.secure_connect)
 
         # screen resolution to guest
         user32 = ctypes.windll.user32
         user32.SetProcessDPIAware()
         width, height = user32.GetSystemMetrics(0), user32.GetSystemMetrics(1)
         self.secure_host.send(self.protocol("resolution", width, height).encode())
+        self.offer_codecs()
+        self.recv_viewport(width, height)
 
         self.secure_host.setblocking(False)         # to handle guest messages
 
+    def offer_codecs(self):
+        """ Offers the guest the codec profiles we can encode and waits for its choice """
+        self.secure_host.send(self.protocol("codecs", *CodecProfile.offer(self.pyav)).encode())
+        self.secure_host.settimeout(ClientHost.codec_timeout)
+        try:
+            choice = self.host_decoder.receive(self.secure_host)
+        except socket.timeout:
+            choice = None
+        finally:
+            self.secure_host.settimeout(None)
+        if choice and choice[0] == "CODEC":
+            self.codec = CodecProfile.get(choice[1]).name
+        print(f"codec: {self.codec}")
+
+    def recv_viewport(self, width: int, height: int):
+        """
+        Receives the size the guest sees our screen at (the video is scaled to it)
+        :param width: our screen width
+        :param height: our screen height
+        """
+        self.viewport = (width, height)
+        self.secure_host.settimeout(ClientHost.codec_timeout)
+        try:
+            viewport = self.host_decoder.receive(self.secure_host)
+        except socket.timeout:
+            viewport = None
+        finally:
+            self.secure_host.settimeout(None)
+        if viewport and viewport[0] == "VIEWPORT" and 0 < viewport[1] <= width and 0 < viewport[2] <= height:
+            self.viewport = (viewport[1], viewport[2])
+        self.scale = (width / self.viewport[0], height / self.viewport[1])
+        print(f"viewport: {self.viewport}")
+
+    def to_host(self, x: int, y: int) -> tuple:
+        """
+        Converts a position in the video to our screen
+        :param x: x coordinate in the video
+        :param y: y coordinate in the video
+        :return: (x, y) on our screen
+        """
+        return int(x * self.scale[0]), int(y * self.scale[1])
+
+    def relay_answer(self):
+        """ Handles the server messages while waiting for the guest, the server can send us to the relay """
+        with self.lock:
+            if self.secure_client.getblocking():      # server communication is in guest mode
+                return
+            try:
+                commands = self.decoder.recv(self.secure_client) or []
+            except ssl.SSLWantReadError:
+                return
+        for command in commands:
+            if command and command[0] == "RELAY":
+                self.connect_relay(*command[1:])
+            elif command and command[0] == "ABORT":
+                raise Exception(command[1])
+
+    def connect_relay(self, tcp_port: int, udp_port: int, token: str):
+        """
+        Connects to the guest through the server relay
+        :param tcp_port: relay port for the input connection
+        :param udp_port: relay port for the video
+        :param token: token that identifies this host in the relay
+        """
+        relay = socket.create_connection((self.server_ip, tcp_port))
+        relay.sendall(token.encode())
+        # the relay only moves bytes, tls is still between host and guest
+        self.secure_host = self.context.wrap_socket(relay, server_side=True)
+        self.video_address = (self.server_ip, udp_port)
+
+    def get_video_address(self) -> tuple:
+        """
+        Gets where the video for the guest is sent
+        :return: address (ip, port)
+        """
+        return self.video_address
+
     def get_guest(self) -> str:
         """
         Gets guest's ip
@@ -353,9 +582,9 @@ class ClientHost(Client):
         try:
             super().present()
             self.secure_client.setblocking(False)
+            self.selector.register(self.secure_client, selectors.EVENT_READ)
             self.connection_host.bind(('0.0.0.0', Client.client_port))             # accepts a connection from anyone
             self.connection_host.listen(ClientHost.listen_size)
-            self.secure_connect = self.context.wrap_socket(self.connection_host, server_side=True)
         except socket.error as err:
             logging.critical(err)
 
@@ -374,30 +603,58 @@ class ClientHost(Client):
         for s in rlist:
             # communication with guest
             try:
-                data = s.recv(Client.max_buffer).decode()
-                print(data)
+                messages = self.host_decoder.recv(s)
+                print(messages)
             except ssl.SSLWantReadError:
                 continue
-            if data == "":
+            if messages is None:
                 # disconnect
                 self.secure_host.close()
                 is_terminated = True
             else:
-                messages = data.split(";;")[:-1]        # separate between messages (last one is supposed to be empty)
                 for message in messages:
-                    message = self.valid_exct(message)
                     if message:
                         command = message[0]
                         args = message[1:]
-                        self.handle_exct(command, *args)         # handle instruction
+                        if command == 'STATS':
+                            if self.on_stats is not None:
+                                self.on_stats(*args)
+                        elif command == 'KEYFRAME':
+                            if self.on_keyframe is not None:
+                                self.on_keyframe()
+                        elif command not in ('CODEC', 'VIEWPORT'):     # only when connecting
+                            self.handle_exct(command, *args)     # handle instruction
             return is_terminated
 
+    def input_to(self, target):
+        """
+        Sets a function to call on every guest instruction (input activity)
+        :param target: function without arguments, None to remove it
+        """
+        self.on_input = target
+
+    def stats_to(self, target):
+        """
+        Sets a function to call with the video stats the guest reports
+        :param target: function that takes (kbps, loss per thousand, delay in ms), None to remove it
+        """
+        self.on_stats = target
+
+    def keyframe_to(self, target):
+        """
+        Sets a function to call when the guest can not decode the video and asks for a keyframe
+        :param target: function without arguments, None to remove it
+        """
+        self.on_keyframe = target
+
     def handle_exct(self, command, *args):
         """
         Executes different commands according to the protocol
         :param command: command to execute
         :param args: arguments of the command
         """
+        if self.on_input is not None:
+            self.on_input()
         if command[:3] == 'KEY':
             command = command[3:]       # takes only the action in the command
             if command == 'PRESS':
@@ -409,23 +666,19 @@ class ClientHost(Client):
         else:               # command is a mouse command
             command = command[5:]       # takes only the action in the command
             if command == 'PRESS':
-                x = int(args[0])
-                y = int(args[1])
+                x, y = self.to_host(int(args[0]), int(args[1]))
                 button = args[2]
                 self.mouse.press(x, y, button)
             elif command == 'RELEASE':
-                x = int(args[0])
-                y = int(args[1])
+                x, y = self.to_host(int(args[0]), int(args[1]))
                 button = args[2]
                 self.mouse.release(x, y, button)
             elif command == 'MOVE':
-                x = int(args[0])
-                y = int(args[1])
+                x, y = self.to_host(int(args[0]), int(args[1]))
                 self.mouse.move(x, y)
             else:           # command is scroll
                 delta = int(args[0])
-                x = int(args[1])
-                y = int(args[2])
+                x, y = self.to_host(int(args[1]), int(args[2]))
                 self.mouse.scroll(delta, x, y)
 
     @staticmethod
@@ -435,7 +688,9 @@ class ClientHost(Client):
         :param instruction: data from the guest to validate its protocol
         :return: if data is valid returns list with command and arguments, if not returns empty list
         """
-        split = instruction.split()
+        if instruction[-2:] != ';;':
+            return []
+        split = instruction[:-2].split()
         if not split or (split[0] not in ClientHost.exct_commands):
             return []
         elif (split[0] == 'MOUSEPRESS' or split[0] == 'MOUSERELEASE') and len(split) == 4:
@@ -446,6 +701,16 @@ class ClientHost(Client):
             return split
         elif split[0] == 'MOUSESCROLL' and len(split) == 5:
             return split
+        elif split[0] == 'STATS' and len(split) == 4 and all(arg.isnumeric() for arg in split[1:]):
+            # STATS kbps loss delay
+            return [split[0]] + [int(arg) for arg in split[1:]]
+        elif split[0] == 'CODEC' and len(split) == 2:
+            return split
+        elif split[0] == 'KEYFRAME' and len(split) == 1:
+            return split
+        elif split[0] == 'VIEWPORT' and len(split) == 3 and split[1].isnumeric() and split[2].isnumeric():
+            # VIEWPORT width height
+            return [split[0], int(split[1]), int(split[2])]
         else:
             return []
 
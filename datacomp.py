@@ -3,49 +3,268 @@ Author: Tomas Dal Farra
 Date: 18/04/2023
 Description: Video encoder/decoder for live-streaming
 """
+import time
+import threading
+import logging
+import socket
+import subprocess
+from collections import deque
+from fractions import Fraction
 import ffmpeg
-from dataget import VideoGather
+import numpy as np
+from dataget import VideoGather, CaptureProcess
+from rtp import CLOCK, RtpPacketizer, RtpSender, JitterBuffer
+try:
+    import av                   # optional in process encoding and decoding (PyAV)
+except ImportError:
+    av = None
+
+PYAV = av is not None
+
+
+class CodecProfile:
+    """
+    Encoder settings of a codec for live-streaming.
+    The host offers the profiles it can encode and the guest chooses the first one it can decode
+    """
+    profiles = {}               # format: {name: profile} in order of preference
+    default = 'h264-ultrafast'  # profile every installation can use
+    installed = {}              # format: {'encoders'/'decoders': names in the installed ffmpeg} (found once)
+    av_installed = {}           # format: {(name, 'w'/'r'): if PyAV has the encoder/decoder} (probed once)
+
+    def __init__(self, name: str, codec: str, container: str, decoders: tuple, refresh=None, **options):
+        """
+        Creates and registers a profile
+        :param name: profile name (it is sent in the protocol, so no spaces)
+        :param codec: ffmpeg encoder
+        :param container: format of the encoded stream
+        :param decoders: ffmpeg decoders that can decode the stream (one is enough)
+        :param refresh: encoder options for a periodic refresh of the whole picture (a lost packet heals by itself)
+        :param options: encoder options
+        """
+        self.name = name
+        self.codec = codec
+        self.container = container
+        self.decoders = decoders
+        self.refresh = refresh if refresh is not None else {'g': '60'}
+        self.options = options
+        self.rtp = container == 'h264'      # h264 is sent in rtp packets (RFC 6184), the rest in bare datagrams
+        CodecProfile.profiles[name] = self
+
+    def output_args(self, bitrate=None, refresh=False) -> dict:
+        """
+        Arguments of the ffmpeg output
+        :param bitrate: maximum bitrate in kbps (None for no limit)
+        :param refresh: refresh the whole picture periodically
+        :return: keyword arguments for the output
+        """
+        args = dict(codec=self.codec, format=self.container, pix_fmt='yuv420p', **self.options)
+        if refresh:
+            args.update(self.refresh)
+        if bitrate is not None:
+            # the rate is capped over half a second of video
+            args.update({'maxrate': f'{bitrate}k', 'bufsize': f'{bitrate // 2}k'})
+            if 'b:v' in self.options:               # libvpx and libaom take the cap as target bitrate
+                args['b:v'] = f'{bitrate}k'
+        return args
+
+    def can_encode(self, pyav=False) -> bool:
+        """
+        :param pyav: encoding with PyAV instead of the ffmpeg subprocess
+        :return: if the backend has the encoder
+        """
+        if pyav:
+            return CodecProfile.av_has(self.codec, 'w')
+        return self.codec in CodecProfile.find('encoders')
+
+    def can_decode(self, pyav=False) -> bool:
+        """
+        :param pyav: decoding with PyAV instead of the ffmpeg subprocess
+        :return: if the backend has one of the decoders
+        """
+        if pyav:
+            return any(CodecProfile.av_has(decoder, 'r') for decoder in self.decoders)
+        return any(decoder in CodecProfile.find('decoders') for decoder in self.decoders)
+
+    @staticmethod
+    def find(kind: str) -> set:
+        """
+        Lists the encoders or decoders of the installed ffmpeg
+        :param kind: encoders or decoders
+        :return: set of names
+        """
+        if kind not in CodecProfile.installed:
+            try:
+                lines = subprocess.run(['ffmpeg', '-hide_banner', f'-{kind}'],
+                                       capture_output=True, text=True).stdout.splitlines()
+            except OSError:
+                lines = []
+            # the list starts after a line of dashes, every line is: flags name description
+            start = next((index + 1 for index, line in enumerate(lines) if line.strip().startswith('---')), 0)
+            CodecProfile.installed[kind] = {line.split()[1] for line in lines[start:] if len(line.split()) > 1}
+        return CodecProfile.installed[kind]
+
+    @staticmethod
+    def av_has(name: str, mode: str) -> bool:
+        """
+        Checks if PyAV has an encoder or a decoder
+        :param name: encoder or decoder name
+        :param mode: 'w' for the encoder, 'r' for the decoder
+        :return: if it is available
+        """
+        if (name, mode) not in CodecProfile.av_installed:
+            try:
+                CodecProfile.av_installed[(name, mode)] = av is not None and av.Codec(name, mode) is not None
+            except ValueError:              # unknown codec
+                CodecProfile.av_installed[(name, mode)] = False
+        return CodecProfile.av_installed[(name, mode)]
+
+    @staticmethod
+    def get(name: str) -> 'CodecProfile':
+        """
+        :param name: profile name
+        :return: the profile (the default one if the name is unknown)
+        """
+        return CodecProfile.profiles.get(name, CodecProfile.profiles[CodecProfile.default])
+
+    @staticmethod
+    def offer(pyav=False) -> list:
+        """
+        :param pyav: the host encodes with PyAV instead of the ffmpeg subprocess
+        :return: names of the profiles this host can encode, in order of preference
+        """
+        offered = [name for name, profile in CodecProfile.profiles.items() if profile.can_encode(pyav)]
+        return offered or [CodecProfile.default]
+
+    @staticmethod
+    def choose(offered: list, pyav=False) -> str:
+        """
+        Chooses the first profile offered by the host that this guest can decode
+        :param offered: names offered by the host
+        :param pyav: the guest decodes with PyAV instead of the ffmpeg subprocess
+        :return: chosen name
+        """
+        for name in offered:
+            if name in CodecProfile.profiles and CodecProfile.profiles[name].can_decode(pyav):
+                return name
+        return CodecProfile.default
+
+
+# h264 (cheapest to encode and decode, the most bandwidth)
+# (x264 intra refresh sends a moving column of intra blocks instead of whole keyframes, so there are no size spikes)
+CodecProfile('h264-ultrafast', 'libx264', 'h264', ('h264',), {'intra-refresh': '1', 'g': '60'},
+             tune='zerolatency', preset='ultrafast', crf='23')
+CodecProfile('h264-veryfast', 'libx264', 'h264', ('h264',), {'intra-refresh': '1', 'g': '60'},
+             tune='zerolatency', preset='veryfast', crf='23')
+# vp8 / vp9 in realtime mode (no frames held back for lookahead)
+CodecProfile('vp8', 'libvpx', 'ivf', ('vp8', 'libvpx'), deadline='realtime', **{
+    'cpu-used': '8', 'lag-in-frames': '0', 'error-resilient': '1', 'crf': '10', 'b:v': '2M'})
+CodecProfile('vp9', 'libvpx-vp9', 'ivf', ('vp9', 'libvpx-vp9'), deadline='realtime', **{
+    'cpu-used': '8', 'row-mt': '1', 'lag-in-frames': '0', 'error-resilient': '1', 'crf': '35', 'b:v': '0'})
+# av1 (the least bandwidth, the most cpu)
+CodecProfile('av1-svt', 'libsvtav1', 'obu', ('libdav1d', 'libaom-av1', 'av1'), preset='12', crf='35')
+CodecProfile('av1-aom', 'libaom-av1', 'obu', ('libdav1d', 'libaom-av1', 'av1'), usage='realtime', **{
+    'cpu-used': '8', 'lag-in-frames': '0', 'row-mt': '1', 'crf': '35', 'b:v': '0'})
 
 
 class StreamEncode:
-    """ Encoding video stream from rawvideo rgb24 to libx264 h264 and from stdin to url """
+    """ Encoding video stream from rawvideo to the codec of a profile and from stdin to url """
     standard_url = 'pipe:'          # standard url of the input for the subprocess
 
-    def __init__(self, width, height, url):
+    keyframe_gap = 0.5              # minimum seconds between requested keyframes
+
+    def __init__(self, width, height, url, pix_fmt='rgb24', bitrate=None, profile=CodecProfile.default,
+                 refresh=False, rtp=False):
         """
-        Gets settings for a ffmpeg subprocess to encode from rawvideo rgb24 to h264 for live-streaming
+        Gets settings for a ffmpeg subprocess to encode from rawvideo (pix_fmt) to the profile codec for live-streaming
         :param width: video data width length
         :param height: video data height length
         :param url: location of the encoded data destination
+        :param pix_fmt: pixel format of the raw frames written to stdin
+        :param bitrate: maximum bitrate in kbps (None for no limit)
+        :param profile: name of the codec profile
+        :param refresh: refresh the whole picture periodically (intra refresh for h264)
+        :param rtp: send the stream to the url (udp://ip:port) in rtp packets (if the profile is sent in rtp)
         """
         self.width = width
         self.height = height
         self.url = url
+        self.pix_fmt = pix_fmt
+        self.bitrate = bitrate
+        self.profile = CodecProfile.get(profile)
+        self.refresh = refresh
         self.process = None
+        self.lock = threading.Lock()        # the process is replaced when the bitrate changes
+        self.keyframe = False               # the next frame has to be a keyframe
+        self.last_keyframe = 0              # last time a keyframe was requested
+        self.sender = RtpSender(url) if rtp and self.profile.rtp else None
 
     def run_encoder(self):
         """ Invokes the ffmpeg subprocess with self settings """
+        url = self.url
+        input_args = {}
+        output_args = self.profile.output_args(self.bitrate, self.refresh)      # encoding format and speed
+        if self.sender is not None:
+            # ffmpeg packetizes to our local port, the capture time of every frame is its timestamp
+            url = self.sender.listen()
+            input_args['use_wallclock_as_timestamps'] = '1'
+            output_args.update(format='rtp', vsync='passthrough', rtpflags='skip_rtcp')   # no sender reports
         self.process = (
             ffmpeg
             .input(
-                StreamEncode.standard_url, format='rawvideo', pix_fmt='rgb24',
-                s=f'{self.width}x{self.height}'
+                StreamEncode.standard_url, format='rawvideo', pix_fmt=self.pix_fmt,
+                s=f'{self.width}x{self.height}', **input_args
             )
             .output(
-                self.url,                                                       # output to url
-                codec='libx264', format='h264', pix_fmt='yuv420p',              # encoding format
-                tune='zerolatency', preset='ultrafast', crf='23',               # quality and speed to encode
+                url,                                                            # output to url
+                **output_args
             )
             # if url is stdout so it opens the pipe
             .run_async(pipe_stdin=True, pipe_stdout=(StreamEncode.standard_url == self.url))
         )
 
+    def set_bitrate(self, bitrate: int):
+        """
+        Restarts the encoder with a new maximum bitrate (the new stream starts with a keyframe)
+        :param bitrate: maximum bitrate in kbps
+        """
+        with self.lock:
+            self.bitrate = bitrate
+            self.restart()
+
+    def restart(self):
+        """ Replaces the ffmpeg process with a new one (the lock must be held) """
+        old = self.process
+        self.run_encoder()
+        old.stdin.close()
+        old.kill()
+
+    def protect(self, loss: int):
+        """
+        Adapts the parity packets to the loss the guest reports (rtp streams only)
+        :param loss: lost datagrams per thousand
+        """
+        if self.sender is not None:
+            self.sender.protect(loss)
+
+    def request_keyframe(self):
+        """ The guest can not decode the stream, the next frame is encoded as a keyframe """
+        now = time.monotonic()
+        if now - self.last_keyframe >= StreamEncode.keyframe_gap:
+            self.last_keyframe = now
+            self.keyframe = True
+
     def write_stdin(self, data):
         """
         Writes data to stdin
-        :param data: input data for stdin
+        :param data: input data for stdin (any buffer, it is written without copying)
         """
-        self.process.stdin.write(data)
+        with self.lock:
+            if self.keyframe:
+                # the ffmpeg process can not be told to make a keyframe, a new process starts with one
+                self.keyframe = False
+                self.restart()
+            self.process.stdin.write(memoryview(data))
 
     def close(self):
         """ Closes the ffmpeg process """
@@ -53,79 +272,779 @@ class StreamEncode:
         if self.url == StreamEncode.standard_url:
             self.process.stdout.close()
         self.process.kill()
+        if self.sender is not None:
+            self.sender.close()
+
+
+class FrameRing:
+    """
+    Preallocated frames shared by a capture thread and a writer thread.
+    The writer always takes the newest frame, older frames that were not taken are dropped
+    """
+
+    def __init__(self, shape: tuple, size=3, frames=None):
+        """
+        Allocates the frames
+        :param shape: shape of every frame
+        :param size: amount of frames (three let capture write while one frame waits and one is being read)
+        :param frames: frames already allocated (shared memory of a capture process), allocated if None
+        """
+        self.frames = frames if frames is not None else [np.empty(shape, np.uint8) for _ in range(size)]
+        self.condition = threading.Condition()
+        self.latest = None          # index of the newest frame that was not taken
+        self.reading = None         # index of the frame being read
+        self.dropped = 0            # frames replaced before being taken
+        self.closed = False
+
+    def free(self) -> int:
+        """
+        :return: index of a frame that can be written (it is not waiting nor being read)
+        """
+        with self.condition:
+            for index in range(len(self.frames)):
+                if index != self.latest and index != self.reading:
+                    return index
+
+    def publish(self, index: int):
+        """
+        Makes a written frame the newest one
+        :param index: index of the frame
+        """
+        with self.condition:
+            if self.latest is not None:
+                self.dropped += 1
+            self.latest = index
+            self.condition.notify()
+
+    def take(self, wait=True):
+        """
+        Waits for a new frame and starts reading it
+        :param wait: wait for a new frame (if False it returns None when there is none)
+        :return: index of the frame, None if the ring was closed
+        """
+        with self.condition:
+            while wait and self.latest is None and not self.closed:
+                self.condition.wait()
+            if self.closed or self.latest is None:
+                return None
+            self.reading, self.latest = self.latest, None
+            return self.reading
+
+    def release(self):
+        """ The frame being read is done """
+        with self.condition:
+            self.reading = None
+
+    def close(self):
+        """ Wakes the reader and stops it """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
 
 
 class ScreenEncode(StreamEncode):
-    """ Encoding screenshots stream from rawvideo rgb24 to libx264 h264 and from stdin to stdout """
+    """ Encoding screenshots stream from rawvideo yuv420p or bgra to the codec of a profile and from stdin to url """
+    repeat_interval = 1         # seconds after which an unchanged screen is sent again (refreshes the guest)
+    ring_size = 3               # preallocated frames between capture and the writer thread
 
-    def __init__(self, url):
+    def __init__(self, url, pix_fmt='yuv420p', separate_process=False, bitrate=None, profile=CodecProfile.default,
+                 size=None, refresh=False, rtp=False):
         """
-        Set settings for a ffmpeg subprocess to encode from rawvideo rgb24 to h264 for live-streaming
+        Set settings for a ffmpeg subprocess to encode from rawvideo to the profile codec for live-streaming
         Specifically made for screen sharing
         :param url: location of the encoded frames destination
+        :param pix_fmt: pixel format of the captured frames
+        (yuv420p is what every profile encodes so ffmpeg does not convert it, bgra is passed as it is captured)
+        :param separate_process: capture in another process (frames are shared through shared memory)
+        :param bitrate: maximum bitrate in kbps (None for no limit)
+        :param profile: name of the codec profile
+        :param size: (width, height) of the video, the screen is scaled to it (screen size if None)
+        :param refresh: refresh the whole picture periodically (intra refresh for h264)
+        :param rtp: send the stream to the url (udp://ip:port) in rtp packets (if the profile is sent in rtp)
         """
-        camera = VideoGather()
-        width = camera.monitor['width']
-        height = camera.monitor['height']
-        super().__init__(width, height, url)
+        if separate_process:
+            camera = CaptureProcess(pix_fmt=pix_fmt, slots=ScreenEncode.ring_size, size=size)
+            frames = camera.frames
+        else:
+            camera = VideoGather(pix_fmt=pix_fmt, size=size)
+            frames = None
+        width, height = camera.size
+        super().__init__(width, height, url, pix_fmt, bitrate, profile, refresh, rtp)
         self.camera = camera
+        self.ring = FrameRing(camera.frame_shape(), ScreenEncode.ring_size, frames)
+        self.writer = None              # thread that writes frames to ffmpeg
+        self.last_write = 0             # last time a frame was sent to ffmpeg
+        self.write_time = 0             # seconds the last frame took to be written (long when ffmpeg is behind)
+        self.times = {'capture': [0.0, 0], 'write': [0.0, 0]}      # format: {stage: [seconds, frames]}
+
+    def run_encoder(self):
+        """ Invokes the ffmpeg subprocess and the thread that writes to it """
+        super().run_encoder()
+        if self.writer is None:
+            self.writer = threading.Thread(target=self.write_frames, name="WriterThread")
+            self.writer.start()
+
+    def capture(self) -> bool:
+        """
+        Captures screen into the ring for the writer thread (only if it changed)
+        :return: if a frame was sent to ffmpeg
+        """
+        start = time.monotonic()
+        repeat = start - self.last_write >= ScreenEncode.repeat_interval
+        index = self.ring.free()
+        frame = self.camera.get_frame(changes_only=not repeat, out=self.ring.frames[index])
+        if frame is None:
+            return False
+        self.ring.publish(index)
+        self.last_write = time.monotonic()
+        self.add_time('capture', self.last_write - start)
+        return True
+
+    def write_frames(self):
+        """ Writes the newest captured frame to ffmpeg until the ring is closed (writer thread) """
+        while True:
+            index = self.ring.take()
+            if index is None:
+                return
+            start = time.monotonic()
+            try:
+                self.write_stdin(self.ring.frames[index])
+            except (OSError, ValueError) as err:        # ffmpeg stopped or stdin was closed
+                logging.error(err)
+                return
+            finally:
+                self.ring.release()
+            self.write_time = time.monotonic() - start
+            self.add_time('write', self.write_time)
+
+    def add_time(self, stage: str, seconds: float):
+        """
+        Adds the time a frame spent in a stage
+        :param stage: capture or write
+        :param seconds: time spent
+        """
+        self.times[stage][0] += seconds
+        self.times[stage][1] += 1
 
-    def capture(self):
-        """ Captures screen and sends it to ffmpeg through stdin """
-        self.write_stdin(self.camera.get_frame())
+    def timing(self) -> str:
+        """
+        :return: average milliseconds per frame of every stage and the frames dropped
+        """
+        stages = [f"{stage}: {total / max(count, 1) * 1000:.2f}ms ({count} frames)"
+                  for stage, (total, count) in self.times.items()]
+        return ", ".join(stages) + f", dropped: {self.ring.dropped}"
 
     def close(self):
-        """ Closes the ffmpeg process and mss clean up """
+        """ Closes the writer thread, the ffmpeg process and mss clean up """
+        self.ring.close()
+        if self.writer is not None:
+            self.writer.join(1)         # it can be blocked writing a frame until ffmpeg reads it
+        print(self.timing())
         super().close()
+        self.ring.frames = []           # shared memory frames are freed by the capture process
         self.camera.close()
 
 
+class AvEncode(StreamEncode):
+    """
+    Encoding video stream in our process with PyAV (same api as StreamEncode).
+    Frames go to the encoder without a pipe and packets are sent from the encoder without a pipe
+    """
+    rate = 30           # frame rate the encoder assumes (frames are numbered, capture times are not used)
+
+    def __init__(self, width, height, url, pix_fmt='rgb24', bitrate=None, profile=CodecProfile.default,
+                 refresh=False, rtp=False):
+        """
+        Gets settings to encode for live-streaming
+        :param width: video data width length
+        :param height: video data height length
+        :param url: location of the encoded data destination (url or a writable file object)
+        :param pix_fmt: pixel format of the raw frames
+        :param bitrate: maximum bitrate in kbps (None for no limit)
+        :param profile: name of the codec profile
+        :param refresh: refresh the whole picture periodically (intra refresh for h264)
+        :param rtp: send the stream to the url (udp://ip:port) in rtp packets (if the profile is sent in rtp)
+        """
+        if av is None:
+            raise ImportError("PyAV is not installed")
+        super().__init__(width, height, url, pix_fmt, bitrate, profile, refresh, rtp)
+        self.container = None
+        self.stream = None
+        self.frames = 0             # frames encoded (presentation time of the next one)
+        self.packetizer = RtpPacketizer() if self.sender is not None else None
+
+    def run_encoder(self):
+        """ Opens the output and the encoder with self settings """
+        args = self.profile.output_args(self.bitrate, self.refresh)
+        options = {('b' if key == 'b:v' else key): value for key, value in args.items()
+                   if key not in ('codec', 'format', 'pix_fmt')}
+        if self.sender is not None:
+            # every packet of the encoder is one frame, it is packetized here so no container is needed
+            self.stream = av.CodecContext.create(self.profile.codec, 'w')
+            self.stream.time_base = Fraction(1, CLOCK)
+            self.stream.framerate = Fraction(AvEncode.rate)
+        else:
+            self.container = av.open(self.url, mode='w', format=self.profile.container)
+            self.stream = self.container.add_stream(self.profile.codec, rate=AvEncode.rate)
+        self.stream.width = self.width
+        self.stream.height = self.height
+        self.stream.pix_fmt = 'yuv420p'
+        self.stream.options = options
+
+    def restart(self):
+        """ Opens the encoder again (the lock must be held) """
+        self.finish()
+        self.run_encoder()
+
+    def write_stdin(self, data):
+        """
+        Encodes a frame and sends its packets
+        :param data: frame as a numpy array in the pixel format of the encoder
+        """
+        frame = av.VideoFrame.from_ndarray(data, format=self.pix_fmt)
+        # rtp timestamps are the capture time in the rtp clock
+        frame.pts = self.frames if self.sender is None else int(time.monotonic() * CLOCK)
+        self.frames += 1
+        with self.lock:
+            if self.keyframe:
+                self.keyframe = False
+                if self.container is not None:
+                    self.restart()          # a restarted container sends its header again (the guest resyncs there)
+                else:                       # the encoder is asked directly, nothing restarts
+                    frame.pict_type = av.video.frame.PictureType.I
+            for packet in self.stream.encode(frame):
+                self.output(packet)
+
+    def output(self, packet):
+        """
+        Sends an encoded packet
+        :param packet: packet of the encoder (one frame)
+        """
+        if self.sender is None:
+            self.container.mux(packet)
+            return
+        for data in self.packetizer.packetize(bytes(packet), int(packet.pts) & 0xFFFFFFFF):
+            self.sender.send(data)
+
+    def finish(self):
+        """ Sends the frames the encoder holds and closes the output """
+        for packet in self.stream.encode(None):
+            self.output(packet)
+        if self.container is not None:
+            self.container.close()
+
+    def close(self):
+        """ Closes the encoder """
+        with self.lock:
+            self.finish()
+        if self.sender is not None:
+            self.sender.close()
+
+
+class AvScreenEncode(ScreenEncode, AvEncode):
+    """ Encoding screenshots stream in our process with PyAV """
+
+
+class FrameScheduler:
+    """
+    Paces the capture loop.
+    It captures at the target fps while the screen changes, slows down while the screen is idle
+    or while the encoder does not keep up, and goes back to the target fps on guest input
+    """
+    min_fps = 5             # slowest pace (idle screen or encoder behind)
+    idle_backoff = 1.5      # interval multiplier for every unchanged frame
+    behind_backoff = 2      # interval multiplier when writing a frame blocks
+    recover = 0.9           # interval multiplier for every frame written in time
+
+    def __init__(self, fps=30):
+        """
+        Creates a scheduler
+        :param fps: target frames per second
+        """
+        self.interval = 1 / fps                         # target interval
+        self.max_interval = 1 / FrameScheduler.min_fps
+        self.pace = self.interval                       # fastest interval the encoder keeps up with
+        self.current = self.interval                    # interval until the next capture
+        self.next = time.monotonic()                    # time of the next capture
+        self.wake = threading.Event()                   # set to capture right away
+
+    def wait(self):
+        """ Waits until it is time for the next capture """
+        delay = self.next - time.monotonic()
+        if delay > 0:
+            self.wake.wait(delay)
+        self.wake.clear()
+
+    def update(self, sent: bool, write_time: float):
+        """
+        Schedules the next capture after the result of the last one
+        :param sent: if the frame changed and was written to the encoder
+        :param write_time: seconds writing the frame took
+        """
+        if sent:
+            if write_time > self.interval:          # the pipe was full, the encoder is behind
+                self.pace = min(self.pace * FrameScheduler.behind_backoff, self.max_interval)
+            else:
+                self.pace = max(self.pace * FrameScheduler.recover, self.interval)
+            self.current = self.pace
+        else:
+            self.current = min(self.current * FrameScheduler.idle_backoff, self.max_interval)
+        # a late capture does not make the next ones burst
+        self.next = max(self.next + self.current, time.monotonic())
+
+    def boost(self):
+        """ There was input activity, the screen is about to change so it captures at full pace """
+        self.current = self.pace
+        self.next = time.monotonic()
+        self.wake.set()
+
+
+class BitrateController:
+    """
+    Keeps the encoder bitrate within what reaches the guest.
+    The guest reports throughput, loss and decoding delay, the bitrate goes down fast on loss or delay
+    and up slowly while the stream uses what it has
+    """
+    min_rate = 300              # kbps
+    max_rate = 20000            # kbps
+    start_rate = 4000           # kbps
+    max_loss = 20               # lost datagrams per thousand before the bitrate goes down
+    max_delay = 150             # milliseconds of decoding delay before the bitrate goes down
+    decrease = 0.7              # bitrate multiplier on congestion
+    increase = 1.15             # bitrate multiplier when the stream uses most of its bitrate
+    restart_gap = 3             # minimum seconds between encoder restarts
+    min_change = 0.1            # smallest relative change worth a restart
+
+    def __init__(self):
+        """ Creates a controller at the starting bitrate """
+        self.target = BitrateController.start_rate
+        self.loss = 0                   # last loss reported (lost datagrams per thousand)
+        self.last_change = time.monotonic()
+
+    def update(self, kbps: int, loss: int, delay: int):
+        """
+        Adapts the target bitrate to a report of the guest
+        :param kbps: throughput received
+        :param loss: lost datagrams per thousand
+        :param delay: decoding delay in milliseconds
+        """
+        self.loss = loss
+        if loss > BitrateController.max_loss or delay > BitrateController.max_delay:
+            # what arrived is the capacity of the path
+            rate = min(self.target, kbps) if kbps > 0 else self.target
+            self.target = max(BitrateController.min_rate, int(rate * BitrateController.decrease))
+        elif kbps >= self.target * 0.8:
+            self.target = min(BitrateController.max_rate, int(self.target * BitrateController.increase))
+
+    def apply(self, encoder: StreamEncode) -> bool:
+        """
+        Restarts the encoder if the target bitrate changed enough (called from the capture loop)
+        :param encoder: encoder to adapt
+        :return: if the encoder was restarted
+        """
+        now = time.monotonic()
+        change = abs(self.target - encoder.bitrate) / encoder.bitrate
+        if change < BitrateController.min_change or now - self.last_change < BitrateController.restart_gap:
+            return False
+        encoder.set_bitrate(self.target)
+        self.last_change = now
+        return True
+
+
+class VideoReceiver:
+    """
+    Receives the udp video stream, feeds it to a decoder and measures what arrives.
+    An rtp stream goes through a jitter buffer, so the decoder gets whole frames in order and loss is measured,
+    lost packets are asked for again to the address the stream comes from
+    """
+    max_datagram = 65536
+
+    def __init__(self, port: int, decoder: 'StreamDecode', rtp=False, nack=True):
+        """
+        Binds the video port
+        :param port: local udp port of the video stream
+        :param decoder: decoder reading from stdin
+        :param rtp: the stream is sent in rtp packets
+        :param nack: ask for lost rtp packets again
+        """
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('0.0.0.0', port))
+        self.decoder = decoder
+        self.source = None          # address the stream comes from (host or relay)
+        self.jitter = JitterBuffer(nack) if rtp else None
+        # frames waiting for a lost packet are checked without packets, and closing the socket
+        # does not wake a blocked recv
+        self.sock.settimeout(JitterBuffer.tick)
+        self.buffer = bytearray(VideoReceiver.max_datagram)     # preallocated, reused for every datagram
+        self.view = memoryview(self.buffer)
+        self.received = 0           # bytes received since the last stats
+        self.datagrams = 0          # datagrams received since the last stats
+        self.lost = 0               # datagrams lost since the last stats (before they were recovered)
+        self.counted = (0, 0)       # packets missing and frames dropped by the jitter buffer already counted
+        self.last_stats = time.monotonic()
+        self.thread = threading.Thread(target=self.receive, name="ReceiverThread")
+
+    def start(self):
+        """ Starts receiving """
+        self.thread.start()
+
+    def receive(self):
+        """ Passes every datagram to the decoder until the socket is closed (receiver thread) """
+        while True:
+            try:
+                try:
+                    size, self.source = self.sock.recvfrom_into(self.buffer)
+                except (socket.timeout, ConnectionResetError):     # windows reports unreachable ports here
+                    size = 0
+                if self.jitter is None:
+                    if size:
+                        self.decoder.write_stdin(self.view[:size])
+                else:
+                    self.play(size)
+            except (OSError, ValueError):       # closed
+                return
+            self.received += size
+            self.datagrams += 1 if size else 0
+
+    def play(self, size: int):
+        """
+        Passes a packet through the jitter buffer and the frames it completes to the decoder
+        :param size: size of the packet in the buffer (0 if none arrived)
+        """
+        if size:
+            self.jitter.push(self.view[:size])
+        for unit in self.jitter.pop():
+            self.decoder.write_stdin(unit)
+        nack = self.jitter.feedback()
+        if nack and self.source is not None:
+            self.sock.sendto(nack, self.source)
+        missing, dropped = self.counted
+        # the loss of the network (the host protects the stream from it), recovered packets included
+        self.lost += self.jitter.missing - missing
+        # a dropped frame breaks the frames after it, like a decoding error
+        self.decoder.errors += self.jitter.dropped - dropped
+        self.counted = (self.jitter.missing, self.jitter.dropped)
+
+    def recovery(self) -> str:
+        """
+        :return: what happened to the missing rtp packets
+        """
+        if self.jitter is None:
+            return "no loss recovery"
+        return (f"missing {self.jitter.missing}: retransmitted {self.jitter.retransmitted}, "
+                f"rebuilt from parity {self.jitter.recovered}, lost {self.jitter.lost} "
+                f"({self.jitter.dropped} frames dropped), reordered {self.jitter.reordered}")
+
+    def stats(self) -> tuple:
+        """
+        Throughput and loss since the last call
+        :return: (kbps, lost datagrams per thousand)
+        """
+        now = time.monotonic()
+        kbps = int(self.received * 8 / 1000 / max(now - self.last_stats, 0.001))
+        loss = self.lost * 1000 // max(self.lost + self.datagrams, 1)
+        self.received = self.datagrams = self.lost = 0
+        self.last_stats = now
+        return kbps, loss
+
+    def close(self):
+        """ Stops receiving """
+        self.sock.close()
+        self.thread.join(1)
+
+
 class StreamDecode:
-    """ Decoding video stream from libx264 h264 to rawvideo rgb24 and from url to stdout """
+    """ Decoding video stream from the codec of a profile to rawvideo rgb24 and from url to stdout """
     standard_url = 'pipe:'  # standard url of the input for the subprocess
+    recovered_frames = 5    # frames decoded without errors after which a broken stream is recovered
+    keyframe_wait = 1       # seconds before asking again for a keyframe that did not fix the stream
+    low_latency = True      # decode every frame as soon as it arrives (no probing nor buffering of the input)
+    pool_size = 3           # preallocated frames read_stdout reads into when it is not given one
 
-    def __init__(self, width, height, url):
+    def __init__(self, width, height, url, profile=CodecProfile.default):
         """
-        Gets settings for a ffmpeg subprocess to decode from libx264 h264 to rawvideo rgb24 for live-streaming
+        Gets settings for a ffmpeg subprocess to decode from the profile codec to rawvideo rgb24 for live-streaming
         :param width: video data width length
         :param height: video data height length
         :param url: location of the encoded data source
+        :param profile: name of the codec profile the stream was encoded with
         """
         self.width = width
         self.height = height
         self.url = url
+        self.profile = CodecProfile.get(profile)
         self.process = None
+        self.pool = []              # preallocated frames (allocated on their first use)
+        self.reads = 0              # frames read
+        self.arrival = None         # when the data of the next frame started arriving
+        self.delays = [0.0, 0]      # format: [seconds, frames] from arrival to decoded frame
+        self.errors = 0             # decoding errors (lost data breaks the frames until a keyframe)
+        self.seen_errors = 0        # errors when the last frame was checked
+        self.request_errors = 0     # errors when the last keyframe was requested
+        self.requested = None       # when the first keyframe of the current recovery was requested
+        self.last_request = 0       # when the last keyframe was requested
+        self.clean = 0              # frames without errors since the stream broke
+        self.first_clean = 0        # time of the first of them
+        self.recoveries = []        # seconds every recovery took
 
     def run_decoder(self):
         """ Invokes the ffmpeg subprocess with self settings """
+        input_args = {}
+        if StreamDecode.low_latency:
+            # the format is known so the input is not probed, and frames are not held back (no b-frames)
+            input_args = dict(fflags='nobuffer', flags='low_delay', probesize='32', analyzeduration='0')
         self.process = (
             ffmpeg
             .input(
-                self.url, format='h264'
+                self.url, format=self.profile.container, **input_args
             )
-            .setpts('N/(25*TB)')                             # set fixed rate of 35 frames per second (to empty buffer)
             .output(
                 'pipe:',  # output to stdout
                 format='rawvideo', pix_fmt='rgb24',                 # decoding format
-                # tune='zerolatency', preset='ultrafast', crf='23',   # quality and speed to encode
-                s=f'{self.width}x{self.height}'
+                s=f'{self.width}x{self.height}',
+                vsync='passthrough'                                 # every frame once, as it is decoded
             )
+            .global_args('-loglevel', 'error')              # only decoding errors are written to stderr
             # if url is stdout it opens the pipe
-            .run_async(pipe_stdin=(StreamDecode.standard_url == self.url), pipe_stdout=True)
+            .run_async(pipe_stdin=(StreamDecode.standard_url == self.url), pipe_stdout=True, pipe_stderr=True)
         )
+        threading.Thread(target=self.watch_errors, name="DecoderErrorsThread", daemon=True).start()
 
-    def read_stdout(self):
+    def watch_errors(self):
+        """ Counts the errors the decoder writes (errors thread) """
+        for _ in self.process.stderr:
+            self.errors += 1
+
+    def write_stdin(self, data):
+        """
+        Writes encoded data to stdin (when url is stdin)
+        :param data: input data for stdin
+        """
+        if self.arrival is None:
+            self.arrival = time.monotonic()
+        self.process.stdin.write(data)
+        self.process.stdin.flush()
+
+    def read_stdout(self, out=None):
+        """
+        Reads the next decoded frame from stdout, all of it (a pipe can give less than a frame at once)
+        :param out: preallocated frame (height, width, 3) to read into, one of the pool if None
+        (a frame of the pool is valid until pool_size more frames are read)
+        :return: rgb24 frame as a numpy array, empty bytes if the decoder was closed (never part of a frame)
+        """
+        if out is None:
+            index = self.reads % StreamDecode.pool_size
+            if index == len(self.pool):
+                self.pool.append(np.empty((self.height, self.width, 3), np.uint8))
+            out = self.pool[index]
+        view = memoryview(out).cast('B')
+        filled = 0
+        while filled < len(view):
+            size = self.process.stdout.readinto(view[filled:])
+            if not size:
+                return b''
+            filled += size
+        self.reads += 1
+        if self.arrival is not None:
+            self.delays[0] += time.monotonic() - self.arrival
+            self.delays[1] += 1
+            self.arrival = None
+        self.track_recovery()
+        return out
+
+    def needs_keyframe(self) -> bool:
+        """
+        :return: if there were errors and a keyframe has to be requested
         """
-        Writes from stdout rgb width * height
+        if self.requested is not None:          # still recovering, asks again only if it broke again
+            return (self.errors != self.request_errors
+                    and time.monotonic() - self.last_request > StreamDecode.keyframe_wait)
+        return self.errors != self.seen_errors
+
+    def keyframe_requested(self):
+        """ A keyframe was requested, the stream is recovering """
+        now = time.monotonic()
+        self.last_request = now
+        if self.requested is None:
+            self.requested = now
+        self.seen_errors = self.errors
+        self.request_errors = self.errors
+        self.clean = 0
+
+    def track_recovery(self):
+        """ Checks if a recovering stream is fixed (called for every decoded frame) """
+        if self.requested is None:          # errors while the stream is fine are left for needs_keyframe
+            return
+        if self.errors != self.seen_errors:
+            self.seen_errors = self.errors
+            self.clean = 0
+            return
+        self.clean += 1
+        if self.clean == 1:
+            self.first_clean = time.monotonic()
+        elif self.clean >= StreamDecode.recovered_frames:
+            self.recoveries.append(self.first_clean - self.requested)
+            self.requested = None
+
+    def recovery(self) -> str:
         """
-        return self.process.stdout.read(self.width * self.height * 3)
+        :return: how long recovering from broken frames took
+        """
+        if not self.recoveries:
+            return "no recoveries"
+        average = sum(self.recoveries) / len(self.recoveries)
+        return f"{len(self.recoveries)} recoveries, average {average * 1000:.0f}ms, worst {max(self.recoveries) * 1000:.0f}ms"
+
+    def delay(self) -> int:
+        """
+        Average decoding delay since the last call
+        :return: milliseconds from the data arriving to its frame being decoded
+        """
+        seconds, frames = self.delays
+        self.delays = [0.0, 0]
+        return int(seconds / max(frames, 1) * 1000)
 
     def close(self):
-        """ Closes the ffmpeg process """
+        """ Closes the ffmpeg process (killed first, so a thread blocked reading stdout gets the end of it) """
+        self.process.kill()
         self.process.stdout.close()
         if self.url == StreamEncode.standard_url:
             self.process.stdin.close()
-        self.process.kill()
+
+
+class AvDecode(StreamDecode):
+    """
+    Decoding video stream in our process with PyAV (same api as StreamDecode).
+    Received data is parsed into packets for the decoder and frames are numpy arrays
+    """
+    max_frames = 8          # decoded frames kept until they are read
+    ivf_header = 32         # bytes of the ivf file header
+    ivf_frame_header = 12   # bytes before every ivf frame (size and time)
+
+    def __init__(self, width, height, url, profile=CodecProfile.default):
+        """
+        Gets settings to decode for live-streaming
+        :param width: video data width length
+        :param height: video data height length
+        :param url: not used (data is given by write_stdin)
+        :param profile: name of the codec profile the stream was encoded with
+        """
+        if av is None:
+            raise ImportError("PyAV is not installed")
+        super().__init__(width, height, url, profile)
+        self.codec = None
+        self.buffer = bytearray()           # ivf data that is not a whole frame yet
+        self.max_frame = width * height * 3 // 2    # largest ivf frame (a raw frame), a bigger size is lost data
+        self.resync = False                 # ivf data is skipped until the header of a restarted encoder
+        self.frames = deque(maxlen=AvDecode.max_frames)
+        self.condition = threading.Condition()
+        self.closed = False
+
+    def run_decoder(self):
+        """ Creates the decoder with self settings """
+        name = next((decoder for decoder in self.profile.decoders if CodecProfile.av_has(decoder, 'r')),
+                    self.profile.decoders[0])
+        self.codec = av.CodecContext.create(name, 'r')
+        if StreamDecode.low_latency:
+            self.codec.options = {'flags': 'low_delay'}
+
+    def write_stdin(self, data):
+        """
+        Decodes received data
+        :param data: encoded data
+        """
+        if self.arrival is None:
+            self.arrival = time.monotonic()
+        try:
+            for packet in self.packets(bytes(data)):
+                for frame in self.codec.decode(packet):
+                    # kept as a frame, read_stdout copies its pixels straight into the preallocated array
+                    image = frame.reformat(width=self.width, height=self.height, format='rgb24')
+                    with self.condition:
+                        self.frames.append(image)
+                        self.condition.notify()
+        except (ValueError, OSError) as err:        # corrupted data, the decoder continues with the next
+            logging.error(err)
+            self.errors += 1
+
+    def packets(self, data: bytes) -> list:
+        """
+        Splits received data into packets
+        :param data: encoded data
+        :return: list of packets
+        """
+        if self.profile.rtp:                # the jitter buffer gives whole access units, no parser has to hold them
+            return [av.Packet(data)]
+        if self.profile.container != 'ivf':
+            return self.codec.parse(data)
+        # ivf: a file header (sent again when the encoder restarts) and frames with their size
+        self.buffer += data
+        packets = []
+        while True:
+            if self.resync:
+                start = self.buffer.find(b'DKIF')
+                if start == -1:
+                    self.errors += 1                # the stream is still broken
+                    del self.buffer[:-3]            # the end can be the start of a header
+                    break
+                del self.buffer[:start]
+                self.resync = False
+            if self.buffer[:4] == b'DKIF':
+                if len(self.buffer) < AvDecode.ivf_header:
+                    break
+                del self.buffer[:AvDecode.ivf_header]
+            if len(self.buffer) < AvDecode.ivf_frame_header:
+                break
+            size = int.from_bytes(self.buffer[:4], 'little')
+            if size > self.max_frame:               # a datagram was lost, this is not a frame header
+                self.errors += 1
+                self.resync = True
+                continue
+            end = AvDecode.ivf_frame_header + size
+            if len(self.buffer) < end:
+                break
+            packets.append(av.Packet(bytes(self.buffer[AvDecode.ivf_frame_header:end])))
+            del self.buffer[:end]
+        return packets
+
+    def keyframe_requested(self):
+        """ A keyframe was requested, ivf data is in sync again at the header of the restarted encoder """
+        super().keyframe_requested()
+        if self.profile.container == 'ivf':
+            self.resync = True
+
+    def read_stdout(self, out=None):
+        """
+        Waits for the next decoded frame
+        :param out: preallocated frame (height, width, 3) to copy it into, None to take the decoded array
+        :return: rgb24 frame as a numpy array, empty bytes if the decoder was closed
+        """
+        with self.condition:
+            while not self.frames and not self.closed:
+                self.condition.wait()
+            if not self.frames:
+                return b''
+            frame = self.frames.popleft()
+        if out is None:
+            frame = frame.to_ndarray()
+        else:
+            # rows of the plane can be padded, only the pixels are copied
+            plane = frame.planes[0]
+            rows = np.frombuffer(plane, np.uint8).reshape(-1, plane.line_size)[:self.height, :self.width * 3]
+            np.copyto(out.reshape(self.height, self.width * 3), rows)
+            frame = out
+        if self.arrival is not None:
+            self.delays[0] += time.monotonic() - self.arrival
+            self.delays[1] += 1
+            self.arrival = None
+        self.track_recovery()
+        return frame
+
+    def close(self):
+        """ Stops the decoder """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
 
 
 def main():
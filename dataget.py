@@ -6,9 +6,12 @@ Description: Module to get all user input and screen output
 from string import ascii_letters
 from tkinter import Tk
 from threading import Lock
+from multiprocessing import Process, Pipe
+from multiprocessing.shared_memory import SharedMemory
 from mss import mss
 import numpy as np
 import cv2 as cv
+import math
 import time
 
 
@@ -172,32 +175,199 @@ class InputKeyBoard:
 
 class VideoGather:
     """ Class to capture all video"""
+    tile = 64           # side of the squares compared to find what changed on the screen
+    # pixel formats of the frames (bgra is the captured one, so it is not converted)
+    # yuv420p (I420) is what the encoder takes, it is half the size of rgb24
+    formats = ('rgb24', 'bgra', 'yuv420p')
+    interpolation = cv.INTER_AREA       # downscaling that keeps text readable
 
-    def __init__(self, sector=1):
+    def __init__(self, sector=1, pix_fmt='rgb24', size=None):
         """
         Video capturer initializer
         :param sector: which monitor to capture.
         zero represents all monitors combined, and one is the main monitor.
+        :param pix_fmt: pixel format of the frames (one of VideoGather.formats)
+        :param size: (width, height) of the frames, the screen is scaled to it (monitor size if None)
         """
+        if pix_fmt not in VideoGather.formats:
+            raise ValueError(f"unsupported pixel format {pix_fmt}")
         self.sct = mss()                            # mss instance to handle screen-capturing
         self.monitor = self.sct.monitors[sector]    # the coordinates and size of the box to capture. (monitor in mss)
+        if pix_fmt == 'yuv420p':
+            # chroma is sampled every two pixels, so the size has to be even
+            self.monitor = dict(self.monitor, width=self.monitor['width'] & ~1, height=self.monitor['height'] & ~1)
+        self.pix_fmt = pix_fmt
+        width, height = size if size is not None else (self.monitor['width'], self.monitor['height'])
+        if pix_fmt == 'yuv420p':
+            width, height = width & ~1, height & ~1
+        self.size = (width, height)
+        self.scaled = None                          # preallocated bgra frame of the scaled screen
+        if self.size != (self.monitor['width'], self.monitor['height']):
+            self.scaled = np.empty((height, width, 4), np.uint8)
+        self.previous = None                        # last frame that changed (bgra)
+        self.dirty_rects = []                       # rectangles (x, y, width, height) changed in the last frame
 
-    def get_frame(self) -> np.ndarray:
+    def frame_shape(self) -> tuple:
         """
-        Captures screen frame in rgb
-        :return: image frame in rgb
+        :return: shape of the frames in the pixel format of the capturer
+        """
+        width, height = self.size
+        if self.pix_fmt == 'yuv420p':
+            # full size luma plane followed by the two quarter size chroma planes
+            return height * 3 // 2, width
+        channels = 4 if self.pix_fmt == 'bgra' else 3
+        return height, width, channels
+
+    def get_frame(self, changes_only=False, out=None):
+        """
+        Captures screen frame in the pixel format of the capturer
+        :param changes_only: if nothing changed since the last frame it returns None (skips the conversion)
+        :param out: preallocated array to put the frame in (with the shape of frame_shape)
+        :return: image frame (in bgra without out it is a view of the captured buffer, nothing is copied)
         """
         image = self.sct.grab(self.monitor)
-        # noinspection PyTypeChecker
-        frame = np.array(image)
-        frame_rgb = cv.cvtColor(frame, cv.COLOR_BGR2RGB)            # changes image format from bgr to rgb
+        frame = np.frombuffer(image.raw, np.uint8).reshape(image.height, image.width, 4)
+        self.dirty_rects = self.damage(frame)
+        if changes_only and not self.dirty_rects:
+            return None
+        if self.scaled is not None:
+            if self.pix_fmt == 'bgra' and out is not None:
+                return cv.resize(frame, self.size, dst=out, interpolation=VideoGather.interpolation)
+            frame = cv.resize(frame, self.size, dst=self.scaled, interpolation=VideoGather.interpolation)
+        if self.pix_fmt == 'bgra':
+            if out is None:
+                return frame
+            np.copyto(out, frame)
+            return out
+        if self.pix_fmt == 'yuv420p':
+            return cv.cvtColor(frame, cv.COLOR_BGRA2YUV_I420, dst=out)
+        frame_rgb = cv.cvtColor(frame, cv.COLOR_BGRA2RGB, dst=out)  # changes image format from bgra to rgb
         return frame_rgb
 
+    def damage(self, frame: np.ndarray) -> list:
+        """
+        Finds which tiles of the screen changed since the last frame
+        :param frame: bgra frame captured
+        :return: list of changed rectangles (x, y, width, height), empty if nothing changed
+        """
+        height, width = frame.shape[:2]
+        if self.previous is None or self.previous.shape != frame.shape:
+            self.previous = frame.copy()
+            return [(0, 0, width, height)]
+        # a bgra pixel is one uint32, so every pixel is compared at once
+        changed = frame.view(np.uint32)[..., 0] != self.previous.view(np.uint32)[..., 0]
+        if not changed.any():
+            return []
+        np.copyto(self.previous, frame)
+        tile = VideoGather.tile
+        rows = np.arange(0, height, tile)
+        cols = np.arange(0, width, tile)
+        tiles = np.logical_or.reduceat(np.logical_or.reduceat(changed, rows, axis=0), cols, axis=1)
+        return self.tiles_to_rects(tiles, width, height)
+
+    @staticmethod
+    def tiles_to_rects(tiles: np.ndarray, width: int, height: int) -> list:
+        """
+        Merges the changed tiles of every row into rectangles
+        :param tiles: boolean grid of changed tiles
+        :param width: frame width
+        :param height: frame height
+        :return: list of rectangles (x, y, width, height)
+        """
+        tile = VideoGather.tile
+        rects = []
+        for row in np.flatnonzero(tiles.any(axis=1)):
+            cols = np.flatnonzero(tiles[row])
+            # consecutive changed tiles are one rectangle
+            for run in np.split(cols, np.flatnonzero(np.diff(cols) > 1) + 1):
+                x = int(run[0]) * tile
+                y = int(row) * tile
+                rects.append((x, y, min((int(run[-1]) + 1) * tile, width) - x, min(y + tile, height) - y))
+        return rects
+
     def close(self):
         """ Closes mss instance """
         self.sct.close()
 
 
+def capture_worker(conn, sector: int, pix_fmt: str, size):
+    """
+    Captures frames into shared memory when asked (runs in the capture process)
+    :param conn: pipe connection with the CaptureProcess
+    :param sector: which monitor to capture
+    :param pix_fmt: pixel format of the frames
+    :param size: (width, height) of the frames (monitor size if None)
+    """
+    camera = VideoGather(sector, pix_fmt, size)
+    conn.send((camera.monitor, camera.size, camera.frame_shape()))
+    memories = [SharedMemory(name) for name in conn.recv()]
+    frames = [np.ndarray(camera.frame_shape(), np.uint8, buffer=memory.buf) for memory in memories]
+    try:
+        while True:
+            request = conn.recv()
+            if request is None:
+                break
+            index, changes_only = request
+            frame = camera.get_frame(changes_only, out=frames[index])
+            conn.send((frame is not None, camera.dirty_rects))
+    finally:
+        del frames              # the shared memory can not close while arrays use it
+        for memory in memories:
+            memory.close()
+        camera.close()
+
+
+class CaptureProcess:
+    """
+    Runs a VideoGather in another process so capturing and converting frames does not hold our GIL.
+    Frames are written in shared memory slots, they are never pickled
+    """
+
+    def __init__(self, sector=1, pix_fmt='rgb24', slots=3, size=None):
+        """
+        Starts the capture process and allocates the frame slots
+        :param sector: which monitor to capture
+        :param pix_fmt: pixel format of the frames (one of VideoGather.formats)
+        :param slots: amount of frames in shared memory
+        :param size: (width, height) of the frames (monitor size if None)
+        """
+        self.conn, child = Pipe()
+        self.process = Process(target=capture_worker, args=(child, sector, pix_fmt, size), name="CaptureProcess")
+        self.process.start()
+        self.monitor, self.size, self.shape = self.conn.recv()
+        self.memories = [SharedMemory(create=True, size=math.prod(self.shape)) for _ in range(slots)]
+        self.frames = [np.ndarray(self.shape, np.uint8, buffer=memory.buf) for memory in self.memories]
+        self.slots = {id(frame): index for index, frame in enumerate(self.frames)}
+        self.conn.send([memory.name for memory in self.memories])
+        self.dirty_rects = []
+
+    def frame_shape(self) -> tuple:
+        """
+        :return: shape of the frames in the pixel format of the capturer
+        """
+        return self.shape
+
+    def get_frame(self, changes_only=False, out=None):
+        """
+        Captures screen frame in the capture process
+        :param changes_only: if nothing changed since the last frame it returns None
+        :param out: slot to put the frame in (one of self.frames)
+        :return: image frame (the slot)
+        """
+        self.conn.send((self.slots[id(out)], changes_only))
+        changed, self.dirty_rects = self.conn.recv()
+        return out if changed else None
+
+    def close(self):
+        """ Stops the capture process and frees the shared memory """
+        self.conn.send(None)
+        self.process.join()
+        self.frames.clear()
+        for memory in self.memories:
+            memory.close()
+            memory.unlink()
+
+
 def test_fps(lim=100) -> str:
     """
     Testes how many fps does the capture function achieve
@@ -0,0 +1,171 @@
+"""
+Author: Tomas Dal Farra
+Date: 16/10/2026
+Description: Incremental decoder for the framed protocol of Remote-Controlling
+"""
+import socket
+import ssl
+from collections import deque
+
+
+class MessageDecoder:
+    """
+    Splits a stream of bytes into protocol messages.
+    protocol: COMMAND arg1 arg2 ... arg;;
+    TCP can merge and split messages, so partial messages are kept between reads
+    """
+    delimiter = b';;'           # end of every message
+    max_length = 1024           # longest message allowed (without a delimiter it is not our protocol)
+
+    def __init__(self, validate, buffer_size=256):
+        """
+        Creates a decoder for one connection
+        :param validate: function that validates one message (with its delimiter) and returns it ordered
+        :param buffer_size: maximum size of each read
+        """
+        self.validate = validate
+        self.buffer = bytearray()                   # bytes received that are not a whole message yet
+        self.scanned = 0                            # bytes of the buffer already searched for a delimiter
+        self.chunk = bytearray(buffer_size)         # reused buffer for every read
+        self.view = memoryview(self.chunk)
+        self.pending = deque()                      # messages decoded that were not taken by receive
+
+    def recv(self, sock: socket.socket):
+        """
+        Reads once from a socket and decodes what arrived
+        :param sock: socket to read from (it can be blocking or not)
+        :return: list of complete messages validated, None if the other end disconnected
+        """
+        size = sock.recv_into(self.view)
+        if size == 0:
+            return None
+        messages = self.feed(self.view[:size])
+        # ssl can hold decrypted data that select does not see
+        while isinstance(sock, ssl.SSLSocket) and sock.pending():
+            size = sock.recv_into(self.view)
+            messages += self.feed(self.view[:size])
+        if self.pending:                # messages left by receive come first
+            messages = list(self.pending) + messages
+            self.pending.clear()
+        return messages
+
+    def receive(self, sock: socket.socket):
+        """
+        Waits for the next whole message (socket must be blocking)
+        :param sock: socket to read from
+        :return: validated message, None if the other end disconnected
+        """
+        while not self.pending:
+            messages = self.recv(sock)
+            if messages is None:
+                return None
+            self.pending.extend(messages)
+        return self.pending.popleft()
+
+    def feed(self, data) -> list:
+        """
+        Adds received data and decodes every complete message in it
+        :param data: bytes-like object received from the connection
+        :return: list with every complete message validated (invalid messages are empty lists)
+        """
+        self.buffer += data
+        messages = []
+        start = 0
+        with memoryview(self.buffer) as view:
+            while True:
+                end = self.buffer.find(MessageDecoder.delimiter, max(self.scanned, start))
+                if end == -1:
+                    break
+                end += len(MessageDecoder.delimiter)
+                messages.append(self.decode(view[start:end]))
+                start = end
+        del self.buffer[:start]
+        # the last byte could be the start of a delimiter
+        self.scanned = max(len(self.buffer) - len(MessageDecoder.delimiter) + 1, 0)
+        if len(self.buffer) > MessageDecoder.max_length:
+            raise ValueError("message is too long")
+        return messages
+
+    def decode(self, frame: memoryview) -> list:
+        """
+        Decodes and validates a single message
+        :param frame: message bytes with its delimiter
+        :return: validated message, empty list if it is not valid
+        """
+        try:
+            return self.validate(str(frame, 'utf-8'))
+        except (UnicodeDecodeError, IndexError):
+            return []
+
+    def clear(self):
+        """ Forgets any partial or pending message """
+        self.buffer.clear()
+        self.scanned = 0
+        self.pending.clear()
+
+
+class SendQueue:
+    """
+    Messages waiting to be sent on a non-blocking socket.
+    A send can write only part of a message, the rest of it stays first in the queue
+    """
+    high_water = 64 * 1024      # bytes waiting from which the queue is full
+
+    def __init__(self, high_water=None):
+        """
+        Creates an empty queue for one connection
+        :param high_water: bytes waiting from which the queue is full (class default if None)
+        """
+        self.high_water = SendQueue.high_water if high_water is None else high_water
+        self.queue = deque()            # memoryviews of the data not sent yet
+        self.size = 0                   # bytes waiting
+        self.sent = 0                   # bytes sent
+        self.peak = 0                   # most bytes that were waiting at once
+
+    def __len__(self) -> int:
+        """
+        :return: how many messages are (fully or partially) waiting
+        """
+        return len(self.queue)
+
+    def put(self, data: bytes):
+        """
+        Adds data to send
+        :param data: data to send (already over protocol)
+        """
+        self.queue.append(memoryview(data))
+        self.size += len(data)
+        self.peak = max(self.peak, self.size)
+
+    def flush(self, sock: socket.socket) -> int:
+        """
+        Sends as much as the socket takes without blocking
+        :param sock: non-blocking socket to send on
+        :return: how many bytes were sent
+        """
+        total = 0
+        while self.queue:
+            data = self.queue[0]
+            try:
+                size = sock.send(data)
+            except (BlockingIOError, ssl.SSLWantWriteError, ssl.SSLWantReadError):
+                break
+            total += size
+            if size < len(data):        # the socket buffer is full
+                self.queue[0] = data[size:]
+                break
+            self.queue.popleft()
+        self.size -= total
+        self.sent += total
+        return total
+
+    def is_full(self) -> bool:
+        """
+        :return: if there is too much data waiting (reading from the other end should wait)
+        """
+        return self.size >= self.high_water
+
+    def clear(self):
+        """ Drops everything that is waiting """
+        self.queue.clear()
+        self.size = 0
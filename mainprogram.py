@@ -8,7 +8,7 @@ from database import DataBase
 from tkinter import Tk
 from menu import MainMenu, PasswordMenu, VisualizeMenu
 from client import ClientHost, ClientGuest
-from datacomp import ScreenEncode
+from datacomp import ScreenEncode, AvScreenEncode, FrameScheduler, BitrateController, PYAV
 import socket
 import threading
 import ssl
@@ -26,30 +26,34 @@ class GuestMode:
         self.root = Tk()
         self.db = database
         self.guest = guest
+        self.guest.pyav = VisualizeMenu.in_process_codec and PYAV      # profiles are chosen for the decoder used
+        self.host_id = None         # host to connect to (sent with the password)
+        self.wrong_id = False       # the host id was not available, it has to be entered again
 
     def connect_id_handler(self, host_id):
         """
         Handles the connection button for the guest mode
+        The id is sent together with the password so connecting takes one round trip
         :param host_id: host's id
         """
-        sec = self.guest.connect_id(host_id)
-        if sec == -1:
-            self.root.destroy()
-            # self.root = Tk()
-        else:
-            # temporal
-            time.sleep(sec)
+        self.host_id = host_id
+        self.root.destroy()
 
     def connect_password_handler(self, password):
         """
         Handles the send button for the guest mode
         :param password: host's password
         """
-        ip, port = self.guest.connect_password(password)
-        if ip == "RETRY":
+        ip, port = self.guest.connect(self.host_id, password)
+        if ip == "RETRY" and port == ClientGuest.id_retry:
+            # the host is not connected (a wrong password gets a shorter retry), back to the id entry
+            self.wrong_id = True
+            self.root.destroy()
+        elif ip == "RETRY":
             time.sleep(port)
         else:
-            if self.guest.connect_to_host(ip, port):
+            # if the host is not reachable directly the server relays the connection
+            if self.guest.connect_to_host(ip, port) or self.guest.connect_relay():
                 self.root.destroy()
 
     def visual_menu(self):
@@ -58,12 +62,12 @@ class GuestMode:
         if width == -1 and height == -1:
             self.guest.secure_guest.close()
         else:
-            menu = VisualizeMenu(self.root, self.guest.secure_guest, width, height)
+            menu = VisualizeMenu(self.root, self.guest.secure_guest, width, height, self.guest.codec)
             try:
-                self.root.after(0, menu.update_image())
+                self.root.after(0, menu.update_image)
                 self.root.mainloop()
             finally:
-                menu.decoder.close()
+                menu.close()
 
     def password_menu(self):
         """ Runs tkinter password window """
@@ -84,11 +88,21 @@ class GuestMode:
         """ Runs the program """
         self.main_menu()
         self.password_menu()
+        while self.wrong_id:
+            self.wrong_id = False
+            self.main_menu()
+            self.password_menu()
         self.visual_menu()
 
 
 class HostMode:
     """ Class to handle host mode """
+    fps = 30                    # target frames per second of the screen sharing
+    capture_process = False     # capture the screen in another process (input handling never waits for it)
+    in_process_codec = True     # encode with PyAV (if it is installed) instead of a ffmpeg subprocess
+    refresh = False             # refresh the picture periodically (lost video heals without asking for keyframes)
+    fec = True                  # send parity packets when the guest reports loss (lost packets are rebuilt)
+
     def __init__(self, server_ip, database, skt, lock):
         """
         Initializes a HostMode instance
@@ -99,6 +113,7 @@ class HostMode:
         """
         self.db = database
         self.host = ClientHost(server_ip, self.db.get_id(), skt, lock)
+        self.host.pyav = HostMode.in_process_codec and PYAV         # profiles are offered for the encoder used
         self.host.start_host()      # first present as a host
         self.host_mode = False
         self.exit_event = threading.Event()       # event to exit capturing
@@ -140,13 +155,29 @@ class HostMode:
 
     def thread_capture(self):
         """ Until the connection is down, capture to an encoder """
-        ip = self.host.get_guest()
-        encoder = ScreenEncode(f'udp://{ip}:{self.host.client_port - 1}')
+        ip, port = self.host.get_video_address()
+        controller = BitrateController()
+        encoder_class = AvScreenEncode if self.host.pyav else ScreenEncode
+        encoder = encoder_class(f'udp://{ip}:{port}', separate_process=HostMode.capture_process,
+                                bitrate=controller.target, profile=self.host.codec, size=self.host.viewport,
+                                refresh=HostMode.refresh, rtp=True)
         encoder.run_encoder()
+        scheduler = FrameScheduler(HostMode.fps)
+        self.host.input_to(scheduler.boost)
+        self.host.stats_to(controller.update)
+        self.host.keyframe_to(encoder.request_keyframe)
         try:
             while not self.exit_event.is_set():
-                encoder.capture()
+                scheduler.wait()
+                sent = encoder.capture()
+                scheduler.update(sent, encoder.write_time)
+                controller.apply(encoder)
+                if HostMode.fec:
+                    encoder.protect(controller.loss)
         finally:
+            self.host.input_to(None)
+            self.host.stats_to(None)
+            self.host.keyframe_to(None)
             encoder.close()  # close encoder
 
 
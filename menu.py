@@ -4,10 +4,11 @@ Date: 04/06/2023
 Description: Implements the GUI for Remote-Controlling
 """
 import sys
+import threading
 from tkinter import Tk, Label, Button, Entry, StringVar
 import cv2 as cv
 from inputsend import InputKeySend, InputMouseSend
-from datacomp import StreamDecode
+from datacomp import StreamDecode, AvDecode, VideoReceiver, CodecProfile, FrameRing, PYAV
 import socket
 import ctypes
 from PIL import ImageTk, Image
@@ -170,13 +171,19 @@ class DisconnectMenu(Menu):
 
 class VisualizeMenu(Menu):
     """ Class to see video stream """
+    stats_interval = 1000       # milliseconds between video stats sent to the host
+    check_interval = 100        # milliseconds between checks of decoding errors
+    display_interval = 5        # milliseconds between checks for a new frame to show
+    ring_size = 3               # preallocated frames (one decoding, one waiting, one shown)
+    in_process_codec = True     # decode with PyAV (if it is installed) instead of a ffmpeg subprocess
 
-    def __init__(self, master: Tk, sock: socket.socket, width=1920, height=1080):
+    def __init__(self, master: Tk, sock: socket.socket, width=1920, height=1080, codec=CodecProfile.default):
         """
         Creates an instance of VisualizeMenu
         :param master: tkinter Tk instance (root)
         :param width: video width
         :param height: video height
+        :param codec: codec profile of the video
         """
         super().__init__(master)
 
@@ -194,23 +201,74 @@ class VisualizeMenu(Menu):
         # sending events
         InputMouseSend(self.master, sock)
         InputKeySend(self.master, sock)
-        # decoder
+        self.sock = sock
+        # decoder (fed by the receiver so what arrives is measured)
         ip, port = sock.getpeername()
         self.width = width
         self.height = height
-        self.decoder = StreamDecode(width, height, f'udp://{ip}:{port-1}')
+        decoder_class = AvDecode if VisualizeMenu.in_process_codec and PYAV else StreamDecode
+        self.decoder = decoder_class(width, height, StreamDecode.standard_url, codec)
         self.decoder.run_decoder()
+        self.receiver = VideoReceiver(port - 1, self.decoder, rtp=CodecProfile.get(codec).rtp)
+        self.receiver.start()
+        # frames are read in the background, the window only shows the newest one (it never waits for the decoder)
+        # they are decoded into preallocated frames, a frame is never written while it waits or is shown
+        self.ring = FrameRing((height, width, 3), VisualizeMenu.ring_size)
+        self.reader = threading.Thread(target=self.read_frames, name="ReaderThread")
+        self.reader.start()
+        self.request_keyframe()         # the stream started before us, it can only be decoded from a keyframe
+        self.master.after(VisualizeMenu.stats_interval, self.send_stats)
+        self.master.after(VisualizeMenu.check_interval, self.check_stream)
+
+    def read_frames(self):
+        """ Keeps the newest decoded frame until the decoder is closed (reader thread) """
+        while True:
+            index = self.ring.free()
+            try:
+                frame = self.decoder.read_stdout(out=self.ring.frames[index])
+            except (OSError, ValueError):       # decoder closed
+                return
+            if not len(frame):
+                return
+            self.ring.publish(index)
 
     def update_image(self):
-        """ Updates images that we are seeing """
-        # sys.stdout.flush()
-        image = self.decoder.read_stdout()
-        if image:
-            image = Image.frombytes('RGB', (self.width, self.height), image)
-            image = ImageTk.PhotoImage(image)
+        """ Updates images that we are seeing (only if a new frame was decoded) """
+        index = self.ring.take(wait=False)
+        if index is not None:
+            image = ImageTk.PhotoImage(Image.fromarray(self.ring.frames[index]))     # copied into tk
+            self.ring.release()
             self.displayer.image = image
             self.displayer.configure(image=image)
-        self.master.after(1, self.update_image)
+        self.master.after(VisualizeMenu.display_interval, self.update_image)
+
+    def send_stats(self):
+        """ Sends the host what arrived since the last stats, so it adapts the bitrate """
+        kbps, loss = self.receiver.stats()
+        delay = self.decoder.delay()
+        self.sock.send(InputMouseSend.protocol("stats", kbps, loss, delay).encode())
+        self.master.after(VisualizeMenu.stats_interval, self.send_stats)
+
+    def request_keyframe(self):
+        """ Asks the host for a keyframe (the video can not be decoded until one arrives) """
+        self.decoder.keyframe_requested()
+        self.sock.send(InputMouseSend.protocol("keyframe").encode())
+
+    def check_stream(self):
+        """ Asks for a keyframe when the decoder had errors (lost video) """
+        if self.decoder.needs_keyframe():
+            self.request_keyframe()
+        self.master.after(VisualizeMenu.check_interval, self.check_stream)
+
+    def close(self):
+        """ Stops receiving and decoding the video """
+        self.receiver.close()
+        self.decoder.close()
+        self.reader.join(1)
+        self.ring.close()
+        print(f"frames skipped: {self.ring.dropped}")
+        print(self.receiver.recovery())
+        print(self.decoder.recovery())
 
 
 def main():
@@ -0,0 +1,334 @@
+"""
+Author: Tomas Dal Farra
+Date: 16/10/2026
+Description: Server relay of the input and video channels for when host and guest can not connect directly
+"""
+import asyncio
+import logging
+import os
+import secrets
+import socket
+
+# linux can move tcp data between sockets inside the kernel (through a pipe) without copying it to python
+SPLICE = hasattr(os, 'splice')
+
+
+class StreamPipe:
+    """ Moves everything from one tcp socket to another (one direction) """
+    chunk = 64 * 1024           # bytes moved at once (a pipe holds 64KiB)
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, src: socket.socket, dst: socket.socket, on_close):
+        """
+        Starts moving data from src to dst
+        :param loop: event loop that watches the sockets
+        :param src: non-blocking socket to read from
+        :param dst: non-blocking socket to write to
+        :param on_close: function called when the pipe stops (either end closed)
+        """
+        self.loop = loop
+        self.src = src
+        self.dst = dst
+        self.on_close = on_close
+        self.pending = 0                # bytes read that were not written yet
+        if SPLICE:
+            self.pipe_r, self.pipe_w = os.pipe()
+        else:
+            self.buffer = bytearray(StreamPipe.chunk)       # preallocated, reused for every read
+            self.view = memoryview(self.buffer)
+            self.start = 0
+        self.closed = False
+        loop.add_reader(src, self.read)
+
+    def read(self):
+        """ Reads one chunk from src (src is readable) """
+        try:
+            if SPLICE:
+                size = os.splice(self.src.fileno(), self.pipe_w, StreamPipe.chunk,
+                                 flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+            else:
+                size = self.src.recv_into(self.view)
+                self.start = 0
+        except BlockingIOError:
+            return
+        except OSError as err:
+            logging.error(err)
+            self.close()
+            return
+        if size == 0:                   # src disconnected
+            self.close()
+            return
+        self.pending = size
+        self.loop.remove_reader(self.src)       # src waits until this chunk is written (backpressure)
+        self.write()
+
+    def write(self):
+        """ Writes what is pending to dst (dst is writable) """
+        try:
+            while self.pending:
+                if SPLICE:
+                    size = os.splice(self.pipe_r, self.dst.fileno(), self.pending,
+                                     flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+                else:
+                    size = self.dst.send(self.view[self.start:self.start + self.pending])
+                    self.start += size
+                self.pending -= size
+        except BlockingIOError:
+            self.loop.add_writer(self.dst, self.write)
+            return
+        except OSError as err:
+            logging.error(err)
+            self.close()
+            return
+        self.loop.remove_writer(self.dst)
+        self.loop.add_reader(self.src, self.read)
+
+    def close(self):
+        """ Stops the pipe """
+        if self.closed:
+            return
+        self.closed = True
+        self.loop.remove_reader(self.src)
+        self.loop.remove_writer(self.dst)
+        if SPLICE:
+            os.close(self.pipe_r)
+            os.close(self.pipe_w)
+        self.on_close()
+
+
+class DatagramRelay:
+    """ Forwards the udp video stream of a host to its guest (and the guest feedback back to the host) """
+    max_datagram = 65536
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, token: str):
+        """
+        Opens a udp socket for one session
+        :param loop: event loop that watches the socket
+        :param token: token the guest sends to register its address
+        """
+        self.loop = loop
+        self.token = token.encode()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('0.0.0.0', 0))
+        self.sock.setblocking(False)
+        self.port = self.sock.getsockname()[1]
+        self.buffer = bytearray(DatagramRelay.max_datagram)      # preallocated, reused for every datagram
+        self.view = memoryview(self.buffer)
+        self.host_ip = None             # video is only taken from the host
+        self.host = None                # address the host sends the video from
+        self.guest = None               # address of the guest (known after it registers)
+        self.forwarded = 0              # bytes forwarded
+        loop.add_reader(self.sock, self.read)
+
+    def read(self):
+        """ Forwards every datagram waiting (socket is readable) """
+        while True:
+            try:
+                size, address = self.sock.recvfrom_into(self.buffer)
+            except (BlockingIOError, ConnectionError):
+                return
+            packet = self.view[:size]
+            if packet == self.token:
+                self.guest = address
+            elif address == self.guest:
+                if self.host is not None:
+                    self.forward(packet, self.host)     # requests of lost packets
+            elif address == self.host or (self.host is None and address[0] == self.host_ip):
+                # the host is known by its ip until its first datagram (both ends can share an ip)
+                self.host = address
+                if self.guest is not None:
+                    self.forward(packet, self.guest)
+
+    def forward(self, packet: memoryview, address: tuple):
+        """
+        Forwards a datagram
+        :param packet: datagram data
+        :param address: destination
+        """
+        try:
+            self.send(packet, address)
+            self.forwarded += len(packet)
+        except BlockingIOError:
+            pass                        # video is lossy anyway
+
+    def send(self, packet: memoryview, address: tuple):
+        """
+        Sends a datagram without copying it
+        :param packet: datagram data
+        :param address: destination
+        """
+        if hasattr(self.sock, 'sendmsg'):
+            self.sock.sendmsg([packet], [], 0, address)
+        else:                           # windows
+            self.sock.sendto(packet, address)
+
+    def close(self):
+        """ Closes the udp socket """
+        self.loop.remove_reader(self.sock)
+        self.sock.close()
+
+
+class RelaySession:
+    """ Relay of one host and one guest """
+
+    def __init__(self, relay: 'Relay', loop: asyncio.AbstractEventLoop):
+        """
+        Creates tokens for both ends and opens the video relay
+        :param relay: relay that has the session
+        :param loop: event loop of the relay
+        """
+        self.relay = relay
+        self.loop = loop
+        self.host_token = secrets.token_hex(Relay.token_length // 2)
+        self.guest_token = secrets.token_hex(Relay.token_length // 2)
+        self.host = None                # tcp socket of the host
+        self.guest = None               # tcp socket of the guest
+        self.pipes = []
+        self.video = DatagramRelay(loop, self.guest_token)
+        self.timeout = loop.call_later(Relay.token_timeout, self.close)     # if both do not join
+        self.closed = False
+
+    def join(self, token: str, sock: socket.socket):
+        """
+        Adds a tcp connection that sent one of the tokens
+        :param token: token sent
+        :param sock: connection socket
+        """
+        if token == self.host_token and self.host is None:
+            self.host = sock
+            self.video.host_ip = sock.getpeername()[0]
+        elif token == self.guest_token and self.guest is None:
+            self.guest = sock
+        else:
+            sock.close()
+            return
+        if self.host is not None and self.guest is not None:
+            self.timeout.cancel()
+            self.pipes = [StreamPipe(self.loop, self.host, self.guest, self.close),
+                          StreamPipe(self.loop, self.guest, self.host, self.close)]
+
+    def close(self):
+        """ Ends the session """
+        if self.closed:
+            return
+        self.closed = True
+        for pipe in self.pipes:
+            pipe.close()
+        for sock in (self.host, self.guest):
+            if sock is not None:
+                sock.close()
+        self.video.close()
+        self.relay.remove(self)
+
+
+class Relay:
+    """ Relays tcp input and udp video between hosts and guests through the server """
+    token_length = 16           # characters of a token
+    token_timeout = 30          # seconds both ends have to join a session
+
+    def __init__(self, port: int):
+        """
+        Creates the relay
+        :param port: tcp port where hosts and guests join their sessions
+        """
+        self.port = port
+        self.listener = None
+        self.loop = None
+        self.sessions = {}              # format: {token: session} (two tokens for each session)
+        self.pending = {}               # format: {socket: [token bytes read, timeout]} (not identified yet)
+
+    def start(self, loop: asyncio.AbstractEventLoop):
+        """
+        Starts listening in an event loop
+        :param loop: event loop to run in
+        """
+        self.loop = loop
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(('0.0.0.0', self.port))
+        self.listener.listen(socket.SOMAXCONN)
+        self.listener.setblocking(False)
+        loop.add_reader(self.listener, self.accept)
+
+    def open(self) -> RelaySession:
+        """
+        Opens a new session
+        :return: the session (its tokens are for the host and the guest)
+        """
+        session = RelaySession(self, self.loop)
+        self.sessions[session.host_token] = session
+        self.sessions[session.guest_token] = session
+        return session
+
+    def remove(self, session: RelaySession):
+        """
+        Forgets a closed session
+        :param session: closed session
+        """
+        self.sessions.pop(session.host_token, None)
+        self.sessions.pop(session.guest_token, None)
+
+    def accept(self):
+        """ Accepts a connection (listener is readable), it is identified after it sends its token """
+        try:
+            sock, _ = self.listener.accept()
+        except BlockingIOError:
+            return
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        timeout = self.loop.call_later(Relay.token_timeout, self.drop, sock)
+        self.pending[sock] = [bytearray(), timeout]
+        self.loop.add_reader(sock, self.identify, sock)
+
+    def identify(self, sock: socket.socket):
+        """
+        Reads the token of a connection and adds it to its session
+        :param sock: connection that sent data
+        """
+        received = self.pending[sock][0]
+        try:
+            data = sock.recv(Relay.token_length - len(received))
+        except BlockingIOError:
+            return
+        except OSError as err:
+            logging.error(err)
+            self.drop(sock)
+            return
+        if not data:                    # disconnected before sending its token
+            self.drop(sock)
+            return
+        received += data
+        if len(received) < Relay.token_length:      # the rest of the token did not arrive yet
+            return
+        self.loop.remove_reader(sock)
+        self.pending.pop(sock)[1].cancel()
+        try:
+            token = received.decode()
+        except UnicodeDecodeError as err:
+            logging.error(err)
+            sock.close()
+            return
+        session = self.sessions.get(token)
+        if session is None:
+            sock.close()
+        else:
+            session.join(token, sock)
+
+    def drop(self, sock: socket.socket):
+        """
+        Closes a connection that did not identify (in time)
+        :param sock: connection socket
+        """
+        _, timeout = self.pending.pop(sock)
+        timeout.cancel()
+        self.loop.remove_reader(sock)
+        sock.close()
+
+    def close(self):
+        """ Closes the relay and all its sessions """
+        for session in list(self.sessions.values()):
+            session.close()
+        for sock in list(self.pending):
+            self.drop(sock)
+        if self.listener is not None:
+            self.loop.remove_reader(self.listener)
+            self.listener.close()
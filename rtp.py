@@ -0,0 +1,606 @@
+"""
+Author: Tomas Dal Farra
+Date: 16/10/2026
+Description: RTP packetization of h264 (RFC 6184), loss recovery (retransmission and parity)
+and a jitter buffer for the video stream of Remote-Controlling
+"""
+import random
+import socket
+import struct
+import threading
+import time
+from collections import deque
+from urllib.parse import urlsplit
+
+HEADER = struct.Struct('!BBHII')        # version/flags, marker/payload type, sequence, timestamp, ssrc
+START_CODE = b'\x00\x00\x00\x01'        # annex b start of a nal unit
+CLOCK = 90000                           # rtp clock of video (ticks per second)
+# nal unit types
+STAP_A = 24                             # several small nal units in one packet
+FU_A = 28                               # fragment of a nal unit that does not fit in a packet
+FRAME_START = (7, 9)                    # sps and access unit delimiter only come first in an access unit
+# loss recovery
+FEC_TYPE = 127                          # payload type of parity packets (xor of a group of packets)
+FEC_HEADER = struct.Struct('!HBH')      # first sequence of the group, packets in it, xor of their lengths
+NACK_TYPE = 205                         # rtcp transport feedback, generic nack (RFC 4585)
+RTCP_TYPES = range(200, 205)            # rtcp reports (sender, receiver, description, bye, app)
+NACK_HEADER = struct.Struct('!BBHII')   # version/format, type, length in words - 1, sender ssrc, media ssrc
+NACK_ENTRY = struct.Struct('!HH')       # lost sequence, bitmask of the 16 sequences after it that were lost
+
+
+def split_nal_units(data: bytes) -> list:
+    """
+    Splits an annex b access unit into its nal units
+    :param data: nal units, each one after a start code (00 00 01 or 00 00 00 01)
+    :return: list of nal units without start codes
+    """
+    units = []
+    start = data.find(b'\x00\x00\x01')
+    while start != -1:
+        start += 3
+        end = data.find(b'\x00\x00\x01', start)
+        if end == -1:
+            units.append(data[start:])
+            break
+        # the zero before a 4 byte start code is not part of the nal unit
+        units.append(data[start:end - 1] if data[end - 1] == 0 else data[start:end])
+        start = end
+    return [unit for unit in units if unit]
+
+
+def xor_packet(parity: int, packet) -> int:
+    """
+    Adds a packet to the parity of a group (packets are padded with zeros to the largest packet)
+    :param parity: parity of the packets before it
+    :param packet: rtp packet
+    :return: new parity
+    """
+    return parity ^ (int.from_bytes(packet, 'big') << 8 * (MAX_PACKET - len(packet)))
+
+
+def nack_packet(sequences: list, ssrc: int) -> bytes:
+    """
+    Creates a generic nack asking for lost packets again
+    :param sequences: sequence numbers of the lost packets (in order)
+    :param ssrc: stream of the packets
+    :return: rtcp packet
+    """
+    entries = []
+    for sequence in sequences:
+        distance = (sequence - entries[-1][0]) & 0xFFFF if entries else 0
+        if 0 < distance <= 16:
+            entries[-1][1] |= 1 << (distance - 1)
+        else:
+            entries.append([sequence, 0])
+    header = NACK_HEADER.pack(0x81, NACK_TYPE, 2 + len(entries), 0, ssrc)
+    return header + b''.join(NACK_ENTRY.pack(sequence, mask) for sequence, mask in entries)
+
+
+def parse_nack(data) -> list:
+    """
+    Reads a generic nack
+    :param data: rtcp packet
+    :return: sequence numbers asked for, empty if it is not a nack
+    """
+    if len(data) < NACK_HEADER.size:
+        return []
+    flags, kind, _, _, _ = NACK_HEADER.unpack_from(data)
+    if flags != 0x81 or kind != NACK_TYPE:
+        return []
+    sequences = []
+    for start in range(NACK_HEADER.size, len(data) - NACK_ENTRY.size + 1, NACK_ENTRY.size):
+        sequence, mask = NACK_ENTRY.unpack_from(data, start)
+        sequences.append(sequence)
+        sequences += [(sequence + bit + 1) & 0xFFFF for bit in range(16) if mask >> bit & 1]
+    return sequences
+
+
+class RtpPacketizer:
+    """ Splits h264 access units into rtp packets (single nal unit packets and FU-A fragments) """
+    mtu = 1200              # largest payload (fits in a datagram on any path)
+
+    def __init__(self, payload_type=96, ssrc=None):
+        """
+        Creates a packetizer for one stream
+        :param payload_type: rtp payload type (dynamic)
+        :param ssrc: stream identifier (random if None)
+        """
+        self.payload_type = payload_type
+        self.ssrc = ssrc if ssrc is not None else random.getrandbits(32)
+        self.sequence = random.getrandbits(16)
+
+    def packetize(self, access_unit: bytes, time_stamp: int) -> list:
+        """
+        Creates the packets of one access unit (one frame)
+        :param access_unit: annex b nal units of the frame
+        :param time_stamp: rtp timestamp of the frame
+        :return: list of packets, the last one has the marker bit
+        """
+        payloads = []
+        for unit in split_nal_units(access_unit):
+            if len(unit) <= RtpPacketizer.mtu:
+                payloads.append(unit)
+                continue
+            # FU-A: indicator (the nal header with type 28) and header (start/end bits and the real type)
+            indicator = (unit[0] & 0xE0) | FU_A
+            kind = unit[0] & 0x1F
+            size = RtpPacketizer.mtu - 2
+            for start in range(1, len(unit), size):
+                fu_header = kind
+                if start == 1:
+                    fu_header |= 0x80
+                if start + size >= len(unit):
+                    fu_header |= 0x40
+                payloads.append(bytes((indicator, fu_header)) + unit[start:start + size])
+        packets = []
+        for index, payload in enumerate(payloads):
+            marker = 0x80 if index == len(payloads) - 1 else 0
+            header = HEADER.pack(0x80, marker | self.payload_type, self.sequence, time_stamp, self.ssrc)
+            packets.append(header + payload)
+            self.sequence = (self.sequence + 1) & 0xFFFF
+        return packets
+
+
+MAX_PACKET = RtpPacketizer.mtu + HEADER.size        # largest rtp packet of the stream
+
+
+class RtpSender:
+    """
+    Sends the rtp packets of the video stream to the guest.
+    Packets come from our packetizer or from ffmpeg (through a local port), every encoder restart starts
+    a new rtp stream so the sequence number and stream identifier are rewritten to keep one continuous stream.
+    Sent packets are kept for a while to send them again when the guest asks (nack),
+    and parity packets let the guest rebuild one lost packet of every group without asking
+    """
+    max_datagram = 65536
+    poll = 0.5                  # seconds the threads wait before checking if the sender was closed
+    history_size = 1024         # packets kept to be sent again
+    fec_loss = 5                # lost packets per thousand from which parity packets are sent
+    min_group = 4               # packets for every parity packet (25% overhead at most)
+    max_group = 20              # (5% overhead at least)
+
+    def __init__(self, url: str):
+        """
+        Opens the socket to the guest
+        :param url: destination of the stream (udp://ip:port)
+        """
+        destination = urlsplit(url)
+        self.address = (destination.hostname, destination.port)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('0.0.0.0', 0))                  # the guest answers with nacks to this port
+        self.sock.settimeout(RtpSender.poll)
+        self.ssrc = random.getrandbits(32)
+        self.sequence = random.getrandbits(16)
+        self.local = None               # socket ffmpeg sends its packets to
+        self.url = None                 # url of the local socket
+        self.thread = None
+        self.history = {}               # format: {sequence: packet} of the last packets sent
+        self.order = deque()            # sequences in the history, oldest first
+        self.group = 0                  # packets for every parity packet (0 sends none)
+        self.parity = 0                 # xor of the packets of the current group
+        self.lengths = 0                # xor of their lengths
+        self.base = 0                   # sequence of the first packet of the group
+        self.count = 0                  # packets in the group
+        self.fec_sequence = random.getrandbits(16)      # parity packets are numbered apart from the video
+        self.sent = 0                   # packets sent
+        self.retransmitted = 0          # packets sent again
+        self.parities = 0               # parity packets sent
+        self.feedback = threading.Thread(target=self.receive_feedback, name="RtpFeedbackThread")
+        self.feedback.start()
+
+    def listen(self) -> str:
+        """
+        Opens a local port for ffmpeg and starts forwarding what it sends (once, restarted encoders use it again)
+        :return: url ffmpeg has to send its rtp packets to
+        """
+        if self.local is not None:
+            return self.url
+        self.local = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.local.bind(('127.0.0.1', 0))
+        self.local.settimeout(RtpSender.poll)          # closing the socket does not wake a blocked recv
+        self.thread = threading.Thread(target=self.forward, name="RtpForwardThread")
+        self.thread.start()
+        self.url = f"udp://127.0.0.1:{self.local.getsockname()[1]}?pkt_size={RtpPacketizer.mtu + HEADER.size}"
+        return self.url
+
+    def forward(self):
+        """ Sends every packet of ffmpeg to the guest until the local socket is closed (forward thread) """
+        buffer = bytearray(RtpSender.max_datagram)      # preallocated, reused for every packet
+        view = memoryview(buffer)
+        while True:
+            try:
+                size = self.local.recv_into(buffer)
+                if size > 1 and buffer[1] in RTCP_TYPES:       # reports of ffmpeg are not video
+                    continue
+                self.send(view[:size])
+            except socket.timeout:
+                continue
+            except OSError:             # closed
+                return
+
+    def send(self, packet):
+        """
+        Sends a packet as the next one of the stream
+        :param packet: rtp packet (bytes-like)
+        """
+        data = bytearray(packet)
+        sequence = self.sequence
+        struct.pack_into('!H', data, 2, sequence)
+        struct.pack_into('!I', data, 8, self.ssrc)
+        self.sequence = (self.sequence + 1) & 0xFFFF
+        self.output(data)
+        self.sent += 1
+        self.history[sequence] = data
+        self.order.append(sequence)
+        if len(self.order) > RtpSender.history_size:
+            del self.history[self.order.popleft()]
+        if self.group or self.count:
+            self.add_parity(data, sequence)
+
+    def output(self, data):
+        """
+        Sends a datagram to the guest
+        :param data: datagram
+        """
+        try:
+            self.sock.sendto(data, self.address)
+        except (BlockingIOError, ConnectionError):
+            pass                        # video is lossy anyway
+
+    def add_parity(self, packet: bytearray, sequence: int):
+        """
+        Adds a sent packet to the parity group, the parity is sent when the group is full
+        or when a frame ends with the group half full (the end of a frame is not protected frames later)
+        :param packet: rtp packet sent
+        :param sequence: its sequence number
+        """
+        if self.count == 0:
+            self.base = sequence
+        self.parity = xor_packet(self.parity, packet)
+        self.lengths ^= len(packet)
+        self.count += 1
+        if self.count < self.group and not (packet[1] & 0x80 and self.count * 2 >= self.group):
+            return
+        header = HEADER.pack(0x80, FEC_TYPE, self.fec_sequence, int.from_bytes(packet[4:8], 'big'), self.ssrc)
+        self.output(header + FEC_HEADER.pack(self.base, self.count, self.lengths)
+                    + self.parity.to_bytes(MAX_PACKET, 'big'))
+        self.fec_sequence = (self.fec_sequence + 1) & 0xFFFF
+        self.parities += 1
+        self.parity = self.lengths = self.count = 0
+
+    def protect(self, loss: int):
+        """
+        Adapts the parity overhead to the loss the guest reports (about twice the loss)
+        :param loss: lost packets per thousand
+        """
+        if loss < RtpSender.fec_loss:
+            self.group = 0
+        else:
+            self.group = min(max(500 // loss, RtpSender.min_group), RtpSender.max_group)
+
+    def receive_feedback(self):
+        """ Sends again the packets the guest asks for until the sender is closed (feedback thread) """
+        buffer = bytearray(RtpSender.max_datagram)
+        while True:
+            try:
+                size = self.sock.recv_into(buffer)
+            except (socket.timeout, ConnectionResetError):      # windows reports unreachable ports here
+                continue
+            except OSError:             # closed
+                return
+            for sequence in parse_nack(buffer[:size]):
+                packet = self.history.get(sequence)
+                if packet is not None:
+                    self.output(packet)
+                    self.retransmitted += 1
+
+    def close(self):
+        """ Stops forwarding and closes the sockets """
+        if self.local is not None:
+            self.local.close()
+            self.thread.join(1)
+        self.sock.close()
+        self.feedback.join(1)
+
+
+class RtpPacket:
+    """ A received rtp packet """
+
+    def __init__(self, data: bytes, arrival: float):
+        """
+        Parses a packet
+        :param data: datagram
+        :param arrival: time it arrived
+        """
+        flags, kind, self.sequence, self.timestamp, self.ssrc = HEADER.unpack_from(data)
+        if flags >> 6 != 2:
+            raise ValueError("not an rtp packet")
+        start = HEADER.size + 4 * (flags & 0x0F)                   # contributing sources
+        if flags & 0x10:                                            # header extension
+            start += 4 + 4 * int.from_bytes(data[start + 2:start + 4], 'big')
+        end = len(data) - (data[-1] if flags & 0x20 else 0)         # padding
+        self.marker = bool(kind & 0x80)
+        self.payload_type = kind & 0x7F
+        self.payload = bytes(data[start:end])
+        self.arrival = arrival
+
+    def starts_frame(self) -> bool:
+        """
+        :return: if the packet is known to be the first of an access unit (it starts with an sps or a delimiter)
+        """
+        kind = self.payload[0] & 0x1F
+        if kind == STAP_A and len(self.payload) > 3:
+            kind = self.payload[3] & 0x1F       # first aggregated nal unit
+        return kind in FRAME_START
+
+    def nal_units(self) -> bytes:
+        """
+        :return: annex b data of the payload (a fragment continues the nal unit of the previous one)
+        """
+        kind = self.payload[0] & 0x1F
+        if kind == FU_A:
+            fu_header = self.payload[1]
+            if fu_header & 0x80:            # first fragment, the nal header is rebuilt
+                return START_CODE + bytes(((self.payload[0] & 0xE0) | (fu_header & 0x1F),)) + self.payload[2:]
+            return self.payload[2:]
+        if kind == STAP_A:
+            units = []
+            index = 1
+            while index + 2 <= len(self.payload):
+                size = int.from_bytes(self.payload[index:index + 2], 'big')
+                units.append(START_CODE + self.payload[index + 2:index + 2 + size])
+                index += 2 + size
+            return b''.join(units)
+        return START_CODE + self.payload
+
+
+class JitterBuffer:
+    """
+    Reorders rtp packets and gives complete access units in order.
+    A missing packet is asked for again (nack) and rebuilt from parity when possible, it is waited for
+    as long as the measured jitter and round trip say it can still arrive, then the frame it belongs to
+    is dropped and the loss is counted
+    """
+    min_delay = 0.005       # seconds a missing packet is waited for at least
+    max_delay = 0.2         # seconds a missing packet is waited for at most
+    jitter_factor = 3       # waiting time in measured jitters
+    tick = 0.005            # seconds between checks when no packet arrives
+    start_rtt = 0.05        # seconds a retransmission is expected to take until one is measured
+    history = 1024          # packets received kept to rebuild lost packets from parity
+    max_parities = 16       # parity packets kept until their group is complete
+
+    def __init__(self, nack=True):
+        """
+        Creates an empty buffer
+        :param nack: ask the host for lost packets
+        """
+        self.nack = nack
+        self.packets = {}           # format: {extended sequence: packet}
+        self.next = None            # extended sequence of the next packet to give
+        self.started = False        # if a packet was given (before that an older packet can still be the first)
+        self.highest = None         # highest extended sequence received
+        self.frame = []             # packets of the access unit being completed
+        self.synced = False         # if the next packet starts a frame (known at the next marker or keyframe)
+        self.jitter = 0.0           # interarrival jitter in seconds (RFC 3550)
+        self.transit = None         # last difference between arrival time and timestamp
+        self.ssrc = 0               # stream of the packets
+        self.recent = {}            # format: {extended sequence: datagram} of the last packets received
+        self.recent_order = deque()
+        self.parities = deque(maxlen=JitterBuffer.max_parities)   # format: [(first, count, lengths, parity)]
+        self.last_parity = None     # when the last parity packet arrived
+        self.parity_gap = 0.0       # seconds between parity packets (a lost packet waits for its parity)
+        self.gaps = {}              # format: {extended sequence: time it was noticed} of packets not arrived yet
+        self.absent = set()         # extended sequences already counted as missing that did not arrive yet
+        self.requests = []          # sequences to ask for that were not sent yet
+        self.requested = {}         # format: {extended sequence: time it was asked for}
+        self.rtt = JitterBuffer.start_rtt
+        self.received = 0           # packets received
+        self.missing = 0            # packets that did not arrive within the jitter (loss of the network)
+        self.reordered = 0          # packets that arrived out of order within the jitter
+        self.retransmitted = 0      # missing packets that arrived after being asked for
+        self.recovered = 0          # missing packets rebuilt from parity
+        self.lost = 0               # packets that never arrived
+        self.late = 0               # packets that arrived after their frame was given up (or twice)
+        self.dropped = 0            # frames dropped because of lost packets
+
+    def delay(self) -> float:
+        """
+        :return: seconds a missing packet is waited for
+        """
+        # it is asked for once it is missing for longer than the jitter
+        wait = self.reorder_delay() + max(self.rtt if self.nack else 0, self.parity_gap)
+        return min(max(wait, JitterBuffer.min_delay), JitterBuffer.max_delay)
+
+    def reorder_delay(self) -> float:
+        """
+        :return: seconds a packet can arrive out of order before it is missing
+        """
+        return min(max(self.jitter * JitterBuffer.jitter_factor, JitterBuffer.min_delay), JitterBuffer.max_delay)
+
+    def extend(self, sequence: int) -> int:
+        """
+        Extends a 16 bit sequence number so it keeps growing after it wraps around
+        :param sequence: sequence number of a packet
+        :return: extended sequence number
+        """
+        if self.highest is None:
+            return sequence
+        extended = (self.highest & ~0xFFFF) | sequence
+        if extended < self.highest - 0x8000:
+            extended += 0x10000
+        elif extended > self.highest + 0x8000:
+            extended -= 0x10000
+        return extended
+
+    def push(self, data, arrival=None):
+        """
+        Adds a received datagram
+        :param data: datagram
+        :param arrival: time it arrived (now if None)
+        """
+        arrival = time.monotonic() if arrival is None else arrival
+        try:
+            packet = RtpPacket(data, arrival)
+        except (ValueError, IndexError, KeyError, struct.error):
+            return
+        if packet.payload_type == FEC_TYPE:
+            self.add_parity(packet)
+            return
+        self.ssrc = packet.ssrc
+        sequence = self.extend(packet.sequence)
+        if self.next is None or (sequence < self.next and not self.started):
+            self.next = sequence
+        if sequence < self.next or sequence in self.packets:
+            self.late += 1
+            return
+        self.received += 1
+        if self.highest is not None and sequence > self.highest + 1:
+            # the packets between them are late, they are missing if they do not arrive within the jitter
+            for missing in range(self.highest + 1, sequence):
+                self.gaps[missing] = arrival
+        self.highest = sequence if self.highest is None else max(self.highest, sequence)
+        self.packets[sequence] = packet
+        self.remember(sequence, data)
+        if self.gaps.pop(sequence, None) is not None:
+            self.reordered += 1
+        self.absent.discard(sequence)
+        asked = self.requested.pop(sequence, None)
+        if asked is not None:
+            # a retransmission tells the round trip, its timestamp is old so it says nothing of the jitter
+            self.retransmitted += 1
+            self.rtt += (arrival - asked - self.rtt) / 8
+            return
+        # interarrival jitter: how much the transit time changes between packets
+        transit = arrival - packet.timestamp / CLOCK
+        if self.transit is not None:
+            change = abs(transit - self.transit)
+            if change < 1:                  # jumps are the timestamp wrapping around or a new encoder
+                self.jitter += (change - self.jitter) / 16
+        self.transit = transit
+
+    def remember(self, sequence: int, data):
+        """
+        Keeps a received packet for parity recovery
+        :param sequence: extended sequence
+        :param data: datagram
+        """
+        self.recent[sequence] = bytes(data)
+        self.recent_order.append(sequence)
+        if len(self.recent_order) > JitterBuffer.history:
+            del self.recent[self.recent_order.popleft()]
+
+    def add_parity(self, packet: RtpPacket):
+        """
+        Keeps a parity packet until its group can be rebuilt
+        :param packet: parity packet
+        """
+        if self.last_parity is not None:
+            self.parity_gap += (packet.arrival - self.last_parity - self.parity_gap) / 8
+        self.last_parity = packet.arrival
+        first, count, lengths = FEC_HEADER.unpack_from(packet.payload)
+        parity = int.from_bytes(packet.payload[FEC_HEADER.size:], 'big')
+        self.parities.append((self.extend(first), count, lengths, parity))
+        self.recover(packet.arrival)
+
+    def recover(self, arrival: float):
+        """
+        Rebuilds the packets that are the only one missing in their parity group
+        :param arrival: time of the recovery
+        """
+        for group in list(self.parities):
+            first, count, lengths, parity = group
+            missing = [sequence for sequence in range(first, first + count) if sequence not in self.recent]
+            if not missing or self.next is None or missing[0] < self.next:
+                self.parities.remove(group)         # nothing lost or it is too late
+                continue
+            if len(missing) > 1:
+                continue
+            self.parities.remove(group)
+            for sequence in range(first, first + count):
+                if sequence != missing[0]:
+                    parity = xor_packet(parity, self.recent[sequence])
+                    lengths ^= len(self.recent[sequence])
+            self.recovered += 1
+            self.requested.pop(missing[0], None)
+            self.count_missing(missing[0])
+            self.push(parity.to_bytes(MAX_PACKET, 'big')[:lengths], arrival)
+
+    def count_missing(self, sequence: int):
+        """
+        Counts a packet that was rebuilt or given up as missing (once, a later packet may never have shown its gap)
+        :param sequence: extended sequence
+        """
+        self.gaps.pop(sequence, None)
+        if sequence in self.absent:
+            self.absent.discard(sequence)
+        else:
+            self.missing += 1
+
+    def check_gaps(self, now: float):
+        """
+        Counts the late packets that did not arrive within the jitter as missing and asks for them
+        :param now: current time
+        """
+        limit = now - self.reorder_delay()
+        for sequence, noticed in list(self.gaps.items()):
+            if noticed > limit:
+                continue
+            del self.gaps[sequence]
+            self.missing += 1
+            self.absent.add(sequence)
+            if self.nack:
+                self.requests.append(sequence & 0xFFFF)
+                self.requested[sequence] = now
+
+    def feedback(self) -> bytes:
+        """
+        :return: nack asking for the missing packets that were not asked for yet, empty if there are none
+        """
+        if not self.requests:
+            return b''
+        requests, self.requests = self.requests, []
+        return nack_packet(requests, self.ssrc)
+
+    def pop(self, now=None) -> list:
+        """
+        Takes the access units that are complete
+        :param now: current time (now if None)
+        :return: list of annex b access units in order
+        """
+        now = time.monotonic() if now is None else now
+        self.check_gaps(now)
+        units = []
+        while self.next is not None and self.next <= self.highest:
+            packet = self.packets.pop(self.next, None)
+            if packet is None:
+                # missing: the oldest packet after it says how long it has been missing
+                oldest = min(self.packets[sequence].arrival for sequence in self.packets)
+                if now - oldest < self.delay():
+                    break
+                self.recover(now)           # the parity of its group can be complete by now
+                if self.next in self.packets:
+                    continue
+                self.lost += 1
+                self.requested.pop(self.next, None)
+                self.count_missing(self.next)
+                self.next += 1
+                self.give_up()
+                continue
+            self.next += 1
+            self.started = True
+            if not self.synced and not packet.starts_frame():
+                self.synced = packet.marker         # the rest of a frame that can not be completed
+                continue
+            self.synced = True
+            self.frame.append(packet)
+            if packet.marker:
+                units.append(b''.join(part.nal_units() for part in self.frame))
+                self.frame = []
+        return units
+
+    def give_up(self):
+        """ A packet was lost, the frame it belongs to is dropped (packets are skipped up to the next marker) """
+        if self.synced or self.frame:
+            self.dropped += 1
+        self.frame = []
+        self.synced = False
@@ -4,14 +4,31 @@ Date: 04/06/2023
 Description: Implementation of the server for Remote-Controlling
 """
 import logging
+import asyncio
 import threading
 import socket
 import ssl
 import time
 import string
-import select
+import selectors
+import heapq
+import sqlite3
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+import sys
 from OpenSSL import crypto
+from cryptography.hazmat.primitives.asymmetric import ec
 import os
+from framing import MessageDecoder
+from relay import Relay
+try:
+    import uvloop               # optional faster event loop
+except ImportError:
+    uvloop = None
+try:
+    import resource             # not available on windows
+except ImportError:
+    resource = None
 
 
 logging.basicConfig(
@@ -41,9 +58,8 @@ def cert_gen():
     cert_file = 'certificate.crt'
     key_file = 'privatekey.key'
 
-    # generate key
-    key = crypto.PKey()
-    key.generate_key(crypto.TYPE_RSA, 4096)
+    # generate key (ecdsa p-256 is generated instantly and makes handshakes much cheaper than rsa 4096)
+    key = crypto.PKey.from_cryptography_key(ec.generate_private_key(ec.SECP256R1()))
     # create self-signed certificate
     cert = crypto.X509()
     cert.get_subject().C = country_name
@@ -69,11 +85,23 @@ def cert_gen():
 class Hosts:
     """ Class with all active hosts """
     id_length = 12
+    ttl = 30                    # seconds a host stays active without being heard from
 
-    def __init__(self):
-        """ initializes the dictionary that contains all hosts """
-        # dictionary format: {id: socket}
+    def __init__(self, directory: 'HostDirectory' = None, port: int = None):
+        """
+        initializes the dictionary that contains all hosts
+        :param directory: directory shared with other worker processes (None if there are no workers)
+        :param port: bridge port of this worker in the directory
+        """
+        # dictionary format: {id: connection}
         self.hosts = {}
+        self.directory = directory
+        self.port = port
+        # dictionary format: {id: last time the host was heard from}
+        self.last_seen = {}
+        # heap of (deadline, id), one entry per host ordered by when it could expire
+        self.deadlines = []
+        self.scheduled = set()          # ids that have an entry in deadlines
 
     @staticmethod
     def is_id(host_id: str) -> bool:
@@ -95,250 +123,595 @@ class Hosts:
                 return False
         return True
 
-    def add(self, host_id: str, skt: socket.socket) -> bool:
+    def add(self, host_id: str, client: 'Connection') -> bool:
         """
         Adds a new active host
         :param host_id: the unique id to identify the host
-        :param skt: socket descriptor connected to client
+        :param client: connection to the client
         :return: if the host was appended successfully
         """
         if self.is_id(host_id):
-            self.hosts[host_id] = skt
+            if host_id not in self.scheduled:
+                heapq.heappush(self.deadlines, (time.monotonic() + Hosts.ttl, host_id))
+                self.scheduled.add(host_id)
+            self.hosts[host_id] = client
+            self.touch(host_id)
+            if self.directory is not None:
+                self.directory.add(host_id, self.port)
             print(f'{host_id} is connected')
             return True
         else:
             return False
 
-    def pop(self, host_id: str) -> socket.socket:
+    def touch(self, host_id: str):
+        """
+        Marks a host as heard from now
+        :param host_id: the unique id to identify the host
+        """
+        if host_id in self.hosts:
+            self.last_seen[host_id] = time.monotonic()
+
+    def pop(self, host_id: str) -> 'Connection':
         """
         Removes a host (is not active)
         :param host_id: the unique id to identify the host
-        :return: removed hosts socket
+        :return: removed hosts connection
         """
+        self.last_seen.pop(host_id, None)       # its deadline is skipped when it is reached
+        if self.directory is not None and host_id in self.hosts:
+            self.directory.remove(host_id, self.port)
         return self.hosts.pop(host_id, None)
 
-    def get(self, host_id: str) -> socket.socket:
+    def discard(self, host_id: str, client: 'Connection'):
         """
-        Gets the host's socket according to their id
+        Removes a host only if it is still registered with this connection
         :param host_id: the unique id to identify the host
-        :return: corresponding host's socket
+        :param client: connection that is not active anymore
+        """
+        if self.hosts.get(host_id) is client:
+            self.pop(host_id)
+
+    def sweep(self) -> list:
+        """
+        Removes the hosts that were not heard from in ttl seconds.
+        Only deadlines that were reached are looked at, so it does not go over all the hosts
+        :return: list of the removed hosts connections
+        """
+        now = time.monotonic()
+        expired = []
+        while self.deadlines and self.deadlines[0][0] <= now:
+            _, host_id = heapq.heappop(self.deadlines)
+            self.scheduled.discard(host_id)
+            if host_id not in self.hosts:               # it was already removed
+                continue
+            deadline = self.last_seen[host_id] + Hosts.ttl
+            if deadline > now:                          # it was heard from after being pushed
+                heapq.heappush(self.deadlines, (deadline, host_id))
+                self.scheduled.add(host_id)
+            else:
+                expired.append(self.pop(host_id))
+        return expired
+
+    def get(self, host_id: str) -> 'Connection':
+        """
+        Gets the host's connection according to their id
+        :param host_id: the unique id to identify the host
+        :return: corresponding host's connection
         """
         return self.hosts.get(host_id)
 
 
+class HostDirectory:
+    """
+    Hosts of every worker process, shared in a sqlite file.
+    Queries run in a thread of the directory one after the other, so the event loop does not wait
+    while another worker holds the write lock
+    """
+
+    def __init__(self, path: str):
+        """
+        Opens (or creates) the directory
+        :param path: sqlite file shared between the workers
+        """
+        # every change commits, the connection is used by the directory thread
+        self.conn = sqlite3.connect(path, timeout=5, isolation_level=None, check_same_thread=False)
+        self.c = self.conn.cursor()
+        # readers do not block the writer and the other way around
+        self.c.execute("PRAGMA journal_mode=WAL")
+        self.c.execute("PRAGMA synchronous=NORMAL")
+        self.c.execute("""CREATE TABLE IF NOT EXISTS hosts (
+                        id text PRIMARY KEY,
+                        port integer
+                        )""")
+        self.thread = ThreadPoolExecutor(1, thread_name_prefix="DirectoryThread")
+
+    def execute(self, query: str, params: dict):
+        """
+        Runs a query (directory thread)
+        :param query: sql query
+        :param params: its parameters
+        :return: first row of the result, None if there is none
+        """
+        try:
+            self.c.execute(query, params)
+            return self.c.fetchone()
+        except sqlite3.Error as err:
+            logging.error(err)
+            return None
+
+    def add(self, host_id: str, port: int):
+        """
+        Registers a host in a worker (without waiting for it)
+        :param host_id: the unique id to identify the host
+        :param port: bridge port of the worker that has the host
+        """
+        self.thread.submit(self.execute, "INSERT OR REPLACE INTO hosts VALUES (:id, :port)",
+                           {'id': host_id, 'port': port})
+
+    def remove(self, host_id: str, port: int):
+        """
+        Removes a host if it is still registered in the worker (without waiting for it)
+        :param host_id: the unique id to identify the host
+        :param port: bridge port of the worker that had the host
+        """
+        self.thread.submit(self.execute, "DELETE FROM hosts WHERE id = :id AND port = :port",
+                           {'id': host_id, 'port': port})
+
+    async def find(self, host_id: str):
+        """
+        Finds which worker has a host
+        :param host_id: the unique id to identify the host
+        :return: bridge port of the worker, None if the host is not registered
+        """
+        row = await asyncio.get_running_loop().run_in_executor(
+            self.thread, self.execute, "SELECT port FROM hosts WHERE id = :id", {'id': host_id})
+        return None if row is None else row[0]
+
+    def clear(self, port: int = None):
+        """
+        Removes the hosts of a worker (without waiting for it)
+        :param port: bridge port of the worker, None removes every host
+        """
+        if port is None:
+            self.thread.submit(self.execute, "DELETE FROM hosts", {})
+        else:
+            self.thread.submit(self.execute, "DELETE FROM hosts WHERE port = :port", {'port': port})
+
+    def close(self):
+        """ Closes the directory handler once the queries sent are done """
+        self.thread.shutdown(wait=True)
+        self.conn.close()
+
+
+class Connection:
+    """ A client connected to the server over tls """
+    high_water = 64 * 1024      # bytes waiting to be written from which the session waits for the client
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """
+        Wraps the stream pair of a connected client
+        :param reader: stream to read from the client
+        :param writer: stream to write to the client
+        """
+        self.reader = reader
+        self.writer = writer
+        self.address = writer.get_extra_info('peername')
+        self.decoder = MessageDecoder(Server.valid, Server.max_buffer)
+        self.events = None              # session queue of (connection, message) once the client is paired
+        self.host_id = None             # id of the client if it presented as a host
+        self.bridged = False            # if the client is a guest relayed by another worker
+        self.task = asyncio.current_task()      # coroutine reading from the client
+        self.sent = 0                   # messages sent to the client
+        # the transport keeps a queue of what is not sent yet, drain waits while it is over high water
+        writer.transport.set_write_buffer_limits(high=Connection.high_water)
+
+    def getpeername(self) -> tuple:
+        """
+        Gets the client's address
+        :return: client's address (ip, port)
+        """
+        return self.address
+
+    def send(self, message: str):
+        """
+        Queues a message to the client (it is written by the event loop)
+        :param message: message for client (already over protocol)
+        """
+        self.writer.write(message.encode())
+        self.sent += 1
+
+    def queue_depth(self) -> int:
+        """
+        Gets how much is waiting to be sent to the client
+        :return: bytes queued
+        """
+        return self.writer.transport.get_write_buffer_size()
+
+    def close(self):
+        """ Closes the connection with the client """
+        self.writer.close()
+
+
 class Server:
     """ Defines the server to communicate with the clients """
     ip = '0.0.0.0'              # ip to bind to
     port = 5010                 # port to bind to
-    listen_size = 5             # maximum listen size
+    listen_size = socket.SOMAXCONN  # maximum listen size
     max_buffer = 256            # maximum receive buffer
+    handshake_timeout = 10      # seconds a client has to finish the tls handshake
+    max_events = 64             # messages a session can have waiting before its clients stop being read
+    sweep_interval = 5          # seconds between searches of hosts that stopped answering
+    bridge_port = 5020          # first loopback port where workers take guests from other workers
+    directory = "hosts.db"      # hosts of all the workers
+    relay_enabled = False       # if host and guest can be relayed when they can not connect directly
+    relay_port = 5030           # first port of the relays (one for each worker)
     # available commands that arrive to server
-    commands = ["PRESENT", "GUESTING", "REQUEST", "ABORT", "RETRY", "CONNECT", "CONNECTED"]
+    commands = ["PRESENT", "GUESTING", "REQUEST", "ABORT", "RETRY", "CONNECT", "CONNECTED", "PING", "RELAY"]
     cert = "certificate.crt"    # SSL certificate
     key = "privatekey.key"      # SSL key
     id_length = 12
 
-    def __init__(self):
-        """ initializes server tcp socket and tls context """
+    def __init__(self, worker: int = None):
+        """
+        initializes server tls context
+        :param worker: number of this worker process, None if the server runs in a single process
+        """
         # ssl context
+        self.cert_thread = None
         if not (os.path.exists(Server.cert) and os.path.exists(Server.key)):
-            # if there is no certificate it creates one
-            cert_gen()
+            # if there is no certificate it creates one in the background (loaded before serving)
+            self.cert_thread = threading.Thread(target=cert_gen, name="CertThread")
+            self.cert_thread.start()
         self.context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
-        self.context.load_cert_chain(Server.cert, Server.key)
-        # sockets
-        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server.setblocking(False)
-        self.waiting_clients = []               # active host waiting and/or potential guests
+        self.server = None                      # asyncio server listening for clients
+        self.waiting_clients = set()            # active host waiting and/or potential guests
+        # workers share their hosts and take guests of each other through a loopback bridge
+        self.worker = worker
+        if worker is None:
+            self.bridge_port = None
+            self.directory = None
+        else:
+            self.bridge_port = Server.bridge_port + worker
+            self.directory = HostDirectory(Server.directory)
+            self.directory.clear(self.bridge_port)          # hosts left by a previous run
         # host and guest handling
-        self.active_hosts = Hosts()
-        self.threads = []
-        self.next_name = 1                      # next thread name
-        self.messages = []                      # messages for client in format (socket, data)
+        self.active_hosts = Hosts(self.directory, self.bridge_port)
+        # relay of input and video (its sockets are watched by the event loop, so not with iocp on windows)
+        self.relay = Relay(Server.relay_port + (worker or 0)) if Server.relay_enabled else None
+        self.sessions = set()                   # running handle_communication tasks
+        self.next_name = 1                      # next session name
 
-    def handle_connection(self, data: str, skt: socket.socket):
+    def handle_connection(self, data: list, client: Connection):
         """
         Handles a client that is in process of establishing a connection.
         It handles their messages according to the protocol identifying themselves
         with the server or giving host id (PRESENT or GUESTING command messages)
-        :param skt: socket of the client
-        :param data: data to handle received from socket
-        It also appends a response to the client to the messages list
+        :param client: connection of the client
+        :param data: message received from the client already validated
+        It also sends a response to the client if needed
         """
-        data = self.valid(data)                 # data processed
         print(data)
         if not data:                            # if data isn't valid
-            self.invalid(skt, f"invalid protocol")
+            self.invalid(client, f"invalid protocol")
         command = data[0]                       # command in data
         args = data[1:]                         # arguments of the command
-        if command == "PRESENT":
-            if not self.active_hosts.add(args[0], skt):
-                self.invalid(skt, "invalid id " + args[0])
+        if command == "PING":                   # keepalive
+            client.send(self.protocol('pong'))
+        elif command == "PRESENT":
+            if not self.active_hosts.add(args[0], client):
+                self.invalid(client, "invalid id " + args[0])
+            client.host_id = args[0]
         elif command == "GUESTING":
-            if args[0] == 'id':                                         # client is giving an id
+            # client is giving an id, or the id and the password together (pair)
+            if args[0] == 'id' or args[0] == 'pair':
+                password = args[2] if args[0] == 'pair' else None
                 if self.active_hosts.is_id(args[1]):                    # if id is in correct format
                     host = self.active_hosts.get(args[1])
-                    if host is not None:                                # if there is an active host with this id
-                        # sending sockets descriptors on a thread to handle them
-                        print(f"{skt.getpeername()} is connecting to {host.getpeername()}")
-                        thread = threading.Thread(target=self.handle_communication, args=(host, skt),
-                                                  name=f"Thread{self.next_name}")
-                        self.threads.append(thread)
-                        self.next_name += 1
+                    # if there is an active host with this id that is not in a session
+                    if host is not None and host in self.waiting_clients:
+                        # both clients are handled by a session coroutine
+                        print(f"{client.getpeername()} is connecting to {host.getpeername()}")
                         # these clients are not waiting anymore
-                        self.waiting_clients.remove(skt)
+                        self.waiting_clients.remove(client)
                         self.waiting_clients.remove(host)
-                        thread.start()
+                        # from now on both clients readers forward their messages to the session
+                        events = asyncio.Queue(Server.max_events)
+                        host.events = events
+                        client.events = events
+                        self.start_session(self.handle_communication(host, client, password), "Session")
+                    elif host is None and self.directory is not None and not client.bridged:
+                        # another worker can have the host (a relayed guest is not relayed again),
+                        # the guest waits for the directory out of the waiting clients
+                        self.waiting_clients.remove(client)
+                        client.events = asyncio.Queue(Server.max_events)
+                        self.start_session(self.bridge_guest(client, args[1], password), "Bridge")
                     else:
-                        self.messages.append((skt, self.protocol("retry", '3')))
+                        client.send(self.protocol("retry", '3'))
                 else:
-                    self.messages.append((skt, self.protocol("retry", '3')))
+                    client.send(self.protocol("retry", '3'))
 
-    def handle_communication(self, host: socket.socket, guest: socket.socket):
+    def start_session(self, coro, name: str):
         """
-        Handles client communication
-        :param host: Socket to communicate with the host client
-        :param guest: Socket to communicate with the guest client
+        Runs a coroutine that handles paired clients
+        :param coro: coroutine of the session
+        :param name: name of the session task
+        """
+        task = asyncio.create_task(coro, name=f"{name}{self.next_name}")
+        self.next_name += 1
+        self.sessions.add(task)
+        task.add_done_callback(self.sessions.discard)
+
+    async def find_worker(self, host_id: str):
+        """
+        Finds another worker process that has a host
+        :param host_id: the unique id to identify the host
+        :return: bridge port of the worker, None if no other worker has it
+        """
+        if self.directory is None:
+            return None
+        port = await self.directory.find(host_id)
+        return None if port == self.bridge_port else port
+
+    async def bridge_guest(self, guest: Connection, host_id: str, password: str = None):
+        """
+        Relays a guest to the worker process that has its host, that worker handles them as usual.
+        If no worker has the host or it is not available there the guest keeps waiting in this worker
+        :param guest: Connection of the guest
+        :param host_id: id of the host
+        :param password: password the guest already gave (None if it waits to be requested)
         """
-        clients = [host, guest]
-        # messages to send (skt to send, data)
-        messages = [(guest, self.protocol('request', 'password'))]
+        port = await self.find_worker(host_id)
+        if port is None:
+            guest.send(self.protocol("retry", '3'))
+            self.wait_again(guest)
+            return
         try:
-            while clients:
-                rlist, wlist, xlist = select.select(clients, clients, clients)
-                # exceptions
-                for s in xlist:
-                    print(f'there is an exception in {s}')
-                    clients.remove(s)
-                    messages.append((clients[0], self.protocol('abort', "The other end had an error")))
-
-                # read from host
-                if host in rlist:
-                    data = host.recv(Server.max_buffer).decode()
-                    print(data)
-                    if data == "":  # if client closed disconnected
-                        clients.remove(host)
-                        messages.append((guest, self.protocol('abort', "The other end disconnected")))
-                    else:
-                        data = self.valid(data)     # data processed
-                        if not data:                # if data isn't valid
-                            messages.append((host, self.protocol('abort', "invalid protocol")))
-                            messages.append((guest, self.protocol('abort', "invalid protocol from the host")))
-                        else:
-                            command = data[0]           # command in data
-                            args = data[1:]             # arguments of the command
-                            if command == "RETRY":
-                                messages.append([host, "RETRY 1;"])     # add time progressively
-                            elif command == "CONNECT":
-                                messages.append([guest, self.protocol(command, host.getpeername()[0], args[0])])
-                            elif command == "CONNECTED":
-                                host.close()
-                                clients.remove(host)
-
-                # read from guest
-                if guest in rlist:
-                    data = guest.recv(Server.max_buffer).decode()
-                    print(data)
-                    if data == "":              # if client closed disconnected
-                        clients.remove(guest)
-                        messages.append((host, self.protocol('abort', "The other end disconnected")))
-                    else:
-                        data = self.valid(data)     # data processed
-                        if not data:                # if data isn't valid
-                            messages.append((guest, self.protocol('abort', "invalid protocol")))
-                            messages.append((host, self.protocol('abort', "invalid protocol from the guest")))
-                        else:
-                            command = data[0]           # command in data
-                            args = data[1:]             # arguments of the command
-                            if command == "GUESTING":
-                                if args[0] == 'password':
-                                    messages.append([host, self.protocol('guesting', args[0], args[1])])
-                            elif command == "CONNECTED":
-                                guest.close()
-                                clients.remove(guest)
-
-                # write
-                for msg in messages:
-                    print(msg)
-                    s = msg[0]
-                    if s in wlist:
-                        s.send(msg[1].encode())
-                        messages.remove(msg)
-                    if msg[1][:5] == "ABORT":
-                        clients.remove(s)
-        except socket.error as err:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        except OSError as err:              # the worker is not running
             logging.error(err)
+            guest.send(self.protocol("retry", '3'))
+            self.wait_again(guest)
+            return
+        try:
+            writer.write(self.protocol('guesting', 'id', host_id).encode())
+            answer = await reader.readuntil(MessageDecoder.delimiter)
+            if answer.startswith(b"REQUEST") and password is not None:
+                # the guest already gave the password, it only waits for the host answer
+                writer.write(self.protocol('guesting', 'password', password).encode())
+            else:
+                guest.writer.write(answer)
+            if answer.startswith(b"REQUEST"):
+                upstream = asyncio.create_task(self.forward_messages(guest.events, writer))
+                try:
+                    while True:             # everything from the other worker goes to the guest as it is
+                        data = await reader.read(Server.max_buffer)
+                        if not data:
+                            break
+                        guest.writer.write(data)
+                        await guest.writer.drain()
+                finally:
+                    upstream.cancel()
+            else:
+                writer.close()
+                self.wait_again(guest)
+                return
+        except (ConnectionError, asyncio.IncompleteReadError, ssl.SSLError) as err:
+            logging.error(err)
+        writer.close()
+        guest.close()
+        guest.task.cancel()
+
+    async def forward_messages(self, events: asyncio.Queue, writer: asyncio.StreamWriter):
+        """
+        Sends the messages of a relayed guest to the worker that has its host
+        :param events: session queue of the guest
+        :param writer: stream to the other worker
+        """
+        while True:
+            _, data = await events.get()
+            if data is None:                    # guest disconnected
+                writer.close()
+                break
+            # an invalid message stays invalid so the other worker aborts
+            writer.write((self.protocol(*data) if data else self.protocol('invalid')).encode())
+            await writer.drain()
+
+    def wait_again(self, client: Connection):
+        """
+        Puts back a client that was taken by a session into waiting
+        :param client: Connection of the client
+        """
+        events = client.events
+        client.events = None
+        self.waiting_clients.add(client)
+        try:
+            while not events.empty():           # messages that arrived meanwhile
+                _, data = events.get_nowait()
+                if data is None:
+                    raise ValueError("client disconnected")
+                self.handle_connection(data, client)
         except ValueError as err:
             logging.error(err)
+            self.waiting_clients.discard(client)
+            client.close()
+            client.task.cancel()
+
+    async def handle_communication(self, host: Connection, guest: Connection, password: str = None):
+        """
+        Handles client communication
+        :param host: Connection to communicate with the host client
+        :param guest: Connection to communicate with the guest client
+        :param password: password the guest already gave (None if it has to be requested)
+        """
+        events = host.events            # messages from both clients
+        clients = {host, guest}
+        if password is None:
+            guest.send(self.protocol('request', 'password'))
+        else:                           # the host answers the guest directly
+            host.send(self.protocol('guesting', 'password', password))
+        try:
+            while clients:
+                client, data = await events.get()
+                if client not in clients:
+                    continue
+                other = guest if client is host else host
+                print(data)
+                if data is None:                # if client closed disconnected
+                    clients.discard(client)
+                    if other in clients:
+                        other.send(self.protocol('abort', "The other end disconnected"))
+                        clients.discard(other)
+                    continue
+                if not data:                    # if data isn't valid
+                    name = "host" if client is host else "guest"
+                    client.send(self.protocol('abort', "invalid protocol"))
+                    other.send(self.protocol('abort', f"invalid protocol from the {name}"))
+                    break
+                command = data[0]               # command in data
+                args = data[1:]                 # arguments of the command
+                if command == "PING":           # keepalive
+                    client.send(self.protocol('pong'))
+                elif client is host:
+                    if command == "RETRY":      # wrong password
+                        guest.send(self.protocol('retry', '1'))     # add time progressively
+                    elif command == "CONNECT":
+                        guest.send(self.protocol(command, host.getpeername()[0], args[0]))
+                    elif command == "CONNECTED":
+                        host.close()
+                        clients.discard(host)
+                else:
+                    if command == "GUESTING":
+                        if args[0] == 'password':
+                            host.send(self.protocol('guesting', args[0], args[1]))
+                        elif args[0] == 'pair':     # a retry of the guest gives the id and the password again
+                            host.send(self.protocol('guesting', 'password', args[2]))
+                    elif command == "RELAY":     # guest could not connect to the host directly
+                        if self.relay is None:
+                            guest.send(self.protocol('abort', "relay is not available"))
+                            host.send(self.protocol('abort', "The other end could not connect"))
+                            break
+                        relay = self.relay.open()
+                        host.send(self.protocol('relay', self.relay.port, relay.video.port, relay.host_token))
+                        guest.send(self.protocol('relay', self.relay.port, relay.video.port, relay.guest_token))
+                    elif command == "CONNECTED":
+                        guest.close()
+                        clients.discard(guest)
+                # waits while a client has too much queued, meanwhile the events queue fills up
+                # and the other client stops being read
+                for client in clients:
+                    await client.writer.drain()
+        except (ConnectionError, ssl.SSLError) as err:
+            logging.error(err)
         finally:
-            host.close()
-            guest.close()
+            for client in (host, guest):
+                client.close()
+                client.task.cancel()        # its reader could be waiting for space in events
 
-    def run_server(self):
-        """ Runs server """
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, bridged=False):
+        """
+        Reads everything a client sends for the lifetime of its connection.
+        While the client is waiting its messages are handled by handle_connection,
+        once it is paired they are forwarded to its session
+        :param reader: stream to read from the client
+        :param writer: stream to write to the client
+        :param bridged: if the client is a guest relayed by another worker
+        """
+        client = Connection(reader, writer)
+        client.bridged = bridged
+        self.waiting_clients.add(client)
         try:
-            self.server.bind((Server.ip, Server.port))
-            self.server.listen(Server.listen_size)
-            secure_server = self.context.wrap_socket(self.server, server_side=True)
-            # handle clients
             while True:
-                rlist, wlist, xlist = select.select([secure_server] + self.waiting_clients,
-                                                    self.waiting_clients,
-                                                    [secure_server] + self.waiting_clients)
-                # exceptions
-                for s in xlist:
-                    print(f'there is an exception in {s}')
-                    if s is secure_server:
-                        raise socket.error("Exception in server socket")
+                data = await reader.read(Server.max_buffer)
+                if not data:                        # if client closed disconnected
+                    if client.events is not None:
+                        await client.events.put((client, None))
+                    break
+                for message in client.decoder.feed(data):
+                    if client.host_id is not None:
+                        self.active_hosts.touch(client.host_id)     # any message keeps the host active
+                    if client.events is not None:   # client is in a session (waits if the session is full)
+                        await client.events.put((client, message))
                     else:
-                        self.waiting_clients.remove(s)
-                # read
-                for s in rlist:
-                    if s is secure_server:          # if there are new clients
-                        client_sock, _ = secure_server.accept()
-                        self.waiting_clients.append(client_sock)
-                    else:                           # communication with client that is in process of a connection
-                        data = s.recv(Server.max_buffer).decode()
-                        print('received ' + data)
-                        if data == "":              # if client closed disconnected
-                            self.waiting_clients.remove(s)
-                        else:
-                            try:
-                                self.handle_connection(data, s)
-                            except ValueError():
-                                s.close()
-                # write
-                for msg in self.messages:
-                    s = msg[0]
-                    if s in wlist:
-                        s.send(msg[1].encode())
-                        self.messages.remove(msg)
+                        self.handle_connection(message, client)
+                await writer.drain()
+        except ValueError as err:
+            logging.error(err)
+        except (ConnectionError, ssl.SSLError) as err:
+            logging.error(err)
+            if client.events is not None:
+                await client.events.put((client, None))
+        finally:
+            self.waiting_clients.discard(client)
+            if client.host_id is not None:
+                self.active_hosts.discard(client.host_id, client)
+            if client.events is None:               # sessions close their own clients
+                client.close()
+
+    async def sweep_hosts(self):
+        """ Periodically removes the hosts that stopped answering """
+        while True:
+            await asyncio.sleep(Server.sweep_interval)
+            for client in self.active_hosts.sweep():
+                logging.info(f"{client.host_id} expired")
+                if client.events is None:       # sessions close their own clients
+                    client.close()
+
+    def load_certificate(self):
+        """ Loads the certificate to the tls context (waits for it if it is being created) """
+        if self.cert_thread is not None:
+            self.cert_thread.join()
+        self.context.load_cert_chain(Server.cert, Server.key)
 
+    async def run_server(self):
+        """ Runs server """
+        sweeper = asyncio.create_task(self.sweep_hosts())
+        try:
+            await asyncio.to_thread(self.load_certificate)
+            if self.relay is not None:
+                self.relay.start(asyncio.get_running_loop())
+            # tls handshakes are driven by the event loop without blocking, a client is handled
+            # (and it is waiting) only after its handshake finishes, slow ones are dropped
+            # workers bind the same port and the kernel balances new clients between them
+            self.server = await asyncio.start_server(self.handle_client, Server.ip, Server.port,
+                                                     ssl=self.context, backlog=Server.listen_size,
+                                                     ssl_handshake_timeout=Server.handshake_timeout,
+                                                     reuse_port=self.worker is not None)
+            if self.worker is not None:
+                # guests that other workers relay here (over loopback, their tls ends in that worker)
+                await asyncio.start_server(lambda r, w: self.handle_client(r, w, bridged=True),
+                                           '127.0.0.1', self.bridge_port)
+            async with self.server:
+                await self.server.serve_forever()
         except socket.error as err:
             logging.critical(err)
         finally:
+            sweeper.cancel()
+            if self.relay is not None:
+                self.relay.close()
             for client in self.waiting_clients:
                 client.close()
-            self.server.close()
-            for thread in self.threads:
-                thread.join()
+            for task in self.sessions:
+                task.cancel()
+            if self.directory is not None:
+                self.directory.clear(self.bridge_port)
+                self.directory.close()
 
-    def invalid(self, sock: socket.socket, reason):
+    def invalid(self, client: Connection, reason):
         """
-        If protocol is invalid then socket aborts
-        :param sock: socket connection
+        If protocol is invalid then client aborts
+        :param client: client connection
         :param reason: reason of the abort message
         """
-        self.send_abort(sock, reason)
+        self.send_abort(client, reason)
         raise ValueError(reason)
 
-    def send_abort(self, sock: socket.socket, reason: str):
+    def send_abort(self, client: Connection, reason: str):
         """
         Sends to client an ABORT message with its corresponding reason
-        :param sock: client socket
+        :param client: client connection
         :param reason: reason of the abort message
         """
-        sock.send(self.protocol("abort", reason).encode())
+        client.send(self.protocol("abort", reason))
 
     @staticmethod
     def valid(data: str) -> list:
@@ -350,14 +723,23 @@ class Server:
         split = data.split()
         if data == "CONNECTED;;":
             return ["CONNECTED"]
+        elif data == "PING;;":
+            return ["PING"]
+        elif data == "RELAY;;":
+            return ["RELAY"]
         elif (split[0] not in Server.commands) or (data[-2:] != ';;'):
             return []
         elif split[0] == "PRESENT" and len(split) == 2 and len(split[1]) == Server.id_length + 2:
             return [split[0], split[1][:-2]]
-        elif split[0] == "GUESTING" and (split[1] == 'id' or split[1] == 'password'):
+        elif split[0] == "GUESTING" and (split[1] == 'id' or split[1] == 'password') and len(split) == 3:
             return [split[0], split[1], split[2][:-2]]
+        elif split[0] == "GUESTING" and split[1] == 'pair' and len(split) == 4:
+            # GUESTING pair id password
+            return [split[0], split[1], split[2], split[3][:-2]]
         elif split[0] == "CONNECT" and len(split) == 2:
             return [split[0], split[1][:-2]]
+        elif split[0] == "RETRY" and len(split) == 2:
+            return [split[0], split[1][:-2]]
         else:
             return []
 
@@ -380,10 +762,77 @@ class Server:
             return f"{command};;"
 
 
-def main():
-    server = Server()
+def new_event_loop() -> asyncio.AbstractEventLoop:
+    """
+    Creates the event loop for the server, uvloop if it is installed.
+    Sockets are registered once and the loop only waits for writing when there is data to write
+    :return: new event loop
+    """
+    if uvloop is not None:
+        return uvloop.new_event_loop()
+    if os.name == 'nt' and not Server.relay_enabled:
+        return asyncio.ProactorEventLoop()      # iocp has no limit of descriptors (the relay needs selectors)
+    # epoll on linux and kqueue on bsd/mac, instead of select that is limited to FD_SETSIZE
+    return asyncio.SelectorEventLoop(selectors.DefaultSelector())
+
+
+def raise_file_limit():
+    """ Lets the process open as many sockets as the system allows (each client is a descriptor) """
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError) as err:
+            logging.warning(f"could not raise the descriptors limit: {err}")
+
+
+def run(worker: int = None):
+    """
+    Runs a server in this process
+    :param worker: number of the worker process, None if the server runs in a single process
+    """
+    server = Server(worker)
+    raise_file_limit()
 
-    server.run_server()
+    loop = new_event_loop()
+    try:
+        loop.run_until_complete(server.run_server())
+    finally:
+        loop.close()
+
+
+def start_workers(count: int) -> list:
+    """
+    Starts worker processes that bind the same port with SO_REUSEPORT and share their hosts
+    :param count: amount of worker processes
+    :return: list of the started processes
+    """
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        raise OSError("worker processes need SO_REUSEPORT")
+    if not (os.path.exists(Server.cert) and os.path.exists(Server.key)):
+        cert_gen()              # before the workers so they do not create it at the same time
+    directory = HostDirectory(Server.directory)
+    directory.clear()
+    directory.close()
+    workers = [multiprocessing.Process(target=run, args=(worker,), name=f"Worker{worker}")
+               for worker in range(count)]
+    for worker in workers:
+        worker.start()
+    return workers
+
+
+def main():
+    # python server.py [amount of worker processes] [--relay]
+    args = [arg for arg in sys.argv[1:] if arg != '--relay']
+    Server.relay_enabled = '--relay' in sys.argv
+    count = int(args[0]) if args else 1
+    if count > 1:
+        for worker in start_workers(count):
+            worker.join()
+    else:
+        run()
 
 
 if __name__ == "__main__":